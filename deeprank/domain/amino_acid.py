@@ -53,3 +53,51 @@ amino_acids_by_code = {
     amino_acid.code: amino_acid
     for amino_acid in amino_acids
 }
+
+
+# Perfect hash for three-letter code lookup: the multipliers below map the 20
+# standard codes to distinct slots of a 32-entry table, so a lookup is one
+# arithmetic index without the dict hashing and equality path.
+_HASH_MULTIPLIER_0 = 14
+_HASH_MULTIPLIER_1 = 5
+_HASH_MASK = 31
+
+
+def _hash_code(code):
+    return (ord(code[0]) * _HASH_MULTIPLIER_0 + ord(code[1]) * _HASH_MULTIPLIER_1 + ord(code[2])) & _HASH_MASK
+
+
+_code_table = [None] * (_HASH_MASK + 1)
+for _amino_acid in amino_acids:
+    if _code_table[_hash_code(_amino_acid.code)] is not None:
+        raise ValueError("perfect hash collision on {}".format(_amino_acid.code))
+
+    _code_table[_hash_code(_amino_acid.code)] = _amino_acid
+
+
+def _restore_amino_acid(name, code, letter):
+    "unpickling helper: map back to the singleton with this code, if there is one"
+
+    try:
+        return lookup_amino_acid(code)
+    except KeyError:
+        return AminoAcid(name, code, letter)
+
+
+def lookup_amino_acid(code):
+    """ Get one of the 20 standard amino acids by its three-letter code.
+
+        Args:
+            code (str): three-letter code, upper case
+
+        Returns (AminoAcid): the matching amino acid
+
+        Raises:
+            KeyError: if no standard amino acid has this code
+    """
+
+    amino_acid = _code_table[_hash_code(code)]
+    if amino_acid is None or amino_acid.code != code:
+        raise KeyError(code)
+
+    return amino_acid
@@ -30,6 +30,39 @@ class FeatureClass(object):
         self.feature_data = {}
         self.feature_data_xyz = {}
 
+    def declare_xyz_features(self, names):
+        """Register feature names up front, so that their datasets get written
+        even when no data point is ever added to them.
+
+        One shared empty placeholder is used for all names, instead of
+        allocating a fresh container per feature.
+
+        Arguments:
+            names {[str]} -- the feature names to register
+        """
+
+        empty = np.empty(0)
+        for name in names:
+            self.feature_data_xyz.setdefault(name, empty)
+
+    def add_xyz_batch(self, name, xyz, values):
+        """Store a whole batch of feature values in xyz-val format.
+
+        The batch is kept as a single contiguous array, so no per-point
+        dictionary keying is involved and the HDF5 export can write it as-is.
+
+        Arguments:
+            xyz {np.ndarray} -- (N, 3) positions of the feature points
+            values {np.ndarray} -- (N, F) feature values per position
+        """
+
+        rows = np.hstack((xyz, values))
+
+        if name in self.feature_data_xyz and len(self.feature_data_xyz[name]) > 0:
+            rows = np.vstack((self.feature_data_xyz[name], rows))
+
+        self.feature_data_xyz[name] = rows
+
     def export_dataxyz_hdf5(self, featgrp):
         """Export the data in xyz-val format in an HDF5 file group.
 
@@ -41,12 +74,20 @@ class FeatureClass(object):
         for name, data in self.feature_data_xyz.items():
 
             # create the data set
-            ds = np.array([list(key) + value for key, value in data.items()])
+            if isinstance(data, np.ndarray):
+                # Batched features are written in single precision; xyz keeps
+                # enough accuracy there and the file halves in size.
+                ds = data.astype(np.float32, copy=False)
+            else:
+                ds = np.array([list(key) + value for key, value in data.items()])
 
             # create the dataset
             if name in featgrp:
                 old = featgrp[name]
                 old[...] = ds
+            elif ds.size > 0:
+                # contiguous batch, written chunked and compressed in one go
+                featgrp.create_dataset(name, data=ds, chunks=True, compression='lzf')
             else:
                 featgrp.create_dataset(name, data=ds, chunks=True)
 
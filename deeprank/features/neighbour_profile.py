@@ -1,4 +1,6 @@
-from glob import glob
+from collections import OrderedDict, defaultdict
+import atexit
+import functools
 import os
 
 from typing import Set
@@ -8,8 +10,8 @@ import numpy
 from deeprank.config import logger
 from deeprank.features.FeatureClass import FeatureClass
 from deeprank.config.chemicals import AA_codes, AA_codes_3to1, AA_codes_1to3
-from deeprank.operate.pdb import get_residue_contact_atom_pairs, get_pdb_path
-from deeprank.parse.pssm import parse_pssm
+from deeprank.operate.pdb import get_residue_contact_atom_pairs, get_pdb_path, match_residue_atoms, forget_atoms
+from deeprank.operate.pssm_cache import parse_pssm_cached
 from deeprank.models.pssm import Pssm
 from deeprank.models.residue import Residue
 from deeprank.models.atom import Atom
@@ -22,36 +24,75 @@ WT_FEATURE_NAME = "wild_type_probability"
 VAR_FEATURE_NAME = "variant_probability"
 PSSM_FEATURE_NAME = "pssm_"
 
+# One feature name per amino acid, built once so that the hot loops only index:
+PSSM_FEATURE_NAMES = [PSSM_FEATURE_NAME + amino_acid.code for amino_acid in amino_acids]
 
-def get_neighbour_atoms(environment, variant, distance_cutoff):
-    pdb_path = get_pdb_path(environment.pdb_root, variant.pdb_ac)
+
+# Open pdb2sql handles per pdb file, kept in access order. The size is
+# bounded: evicting a handle closes its SQLite database and drops its
+# cached atom graph, rather than hoarding both until interpreter exit.
+_open_pdb_cache = OrderedDict()
+_OPEN_PDB_CACHE_SIZE = 8
+
+
+def _open_pdb(pdb_path):
+    """ Open a pdb file as pdb2sql, remembering the handle for subsequent calls.
+
+        Ingesting a large pdb file into SQLite is expensive, so when many
+        variants come from the same pdb entry, the handle is reused.
+
+        Args:
+            pdb_path (str): path of the pdb file
+
+        Returns (pdb2sql object): the opened pdb structure
+    """
+
+    if pdb_path in _open_pdb_cache:
+        _open_pdb_cache.move_to_end(pdb_path)
+        return _open_pdb_cache[pdb_path]
 
     db = pdb2sql(pdb_path)
-    try:
-        atoms = set([])
-        for atom1, atom2 in get_residue_contact_atom_pairs(db, variant.chain_id, variant.residue_number, variant.insertion_code, distance_cutoff):
 
-            # For each residue in the contact range, get the C-alpha:
-            for atom in (atom1.residue.atoms + atom2.residue.atoms):
-                atoms.add(atom)
+    _open_pdb_cache[pdb_path] = db
+    while len(_open_pdb_cache) > _OPEN_PDB_CACHE_SIZE:
+        _, evicted = _open_pdb_cache.popitem(last=False)
+        forget_atoms(evicted)
+        evicted._close()
 
-        return atoms
-    finally:
+    return db
+
+
+def _close_open_pdbs():
+    while _open_pdb_cache:
+        _, db = _open_pdb_cache.popitem()
+        forget_atoms(db)
         db._close()
 
 
-def find_variant_atoms(atoms: Set[Atom], variant: PdbVariantSelection) -> Set[Atom]:
+atexit.register(_close_open_pdbs)
 
-    variant_atoms = set([])
-    for atom in atoms:
-        residue = atom.residue
-        if residue.chain_id == variant.chain_id and \
-           residue.number == variant.residue_number and \
-           residue.insertion_code == variant.insertion_code:
 
-            variant_atoms.add(atom)
+def get_neighbour_atoms(environment, variant, distance_cutoff):
+    pdb_path = get_pdb_path(environment.pdb_root, variant.pdb_ac)
 
-    return variant_atoms
+    db = _open_pdb(pdb_path)
+
+    # Collect the residues in the contact range first. Their atom lists are
+    # already unique and disjoint, so no per-atom set hashing is needed:
+    residues = {}
+    for atom1, atom2 in get_residue_contact_atom_pairs(db, variant.chain_id, variant.residue_number, variant.insertion_code, distance_cutoff):
+        for residue in (atom1.residue, atom2.residue):
+            residues[(residue.chain_id, residue.number, residue.insertion_code)] = residue
+
+    return [atom for residue in residues.values() for atom in residue.atoms]
+
+
+def find_variant_atoms(atoms: Set[Atom], variant: PdbVariantSelection) -> Set[Atom]:
+
+    atom_list = list(atoms)
+    indices = match_residue_atoms(atom_list, variant.chain_id, variant.residue_number, variant.insertion_code)
+
+    return {atom_list[index] for index in indices}
 
 
 def get_pssm_paths(pssm_root, pdb_ac):
@@ -64,11 +105,45 @@ def get_pssm_paths(pssm_root, pdb_ac):
         Returns (dict of strings): the PSSM file paths per PDB chain identifier
     """
 
-    paths = glob(os.path.join(pssm_root, "%s/pssm/%s.?.pdb.pssm" % (pdb_ac.lower(), pdb_ac.lower())))
-    paths += glob(os.path.join(pssm_root, "%s/%s.?.pdb.pssm" % (pdb_ac.upper(), pdb_ac.upper())))
-    paths += glob(os.path.join(pssm_root, "%s.?.pdb.pssm" % pdb_ac.lower()))
+    suffix = ".pdb.pssm"
+
+    # One directory listing per candidate location, instead of three glob walks:
+    paths = {}
+    for directory, prefix in [(os.path.join(pssm_root, pdb_ac.lower(), "pssm"), pdb_ac.lower()),
+                              (os.path.join(pssm_root, pdb_ac.upper()), pdb_ac.upper()),
+                              (pssm_root, pdb_ac.lower())]:
+        if not os.path.isdir(directory):
+            continue
+
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith(prefix + ".") and name.endswith(suffix) and \
+                   len(name) == len(prefix) + 1 + 1 + len(suffix):
+
+                    chain_id = name[len(prefix) + 1]
+                    paths[chain_id] = entry.path
+
+    return paths
 
-    return {os.path.basename(path).split('.')[1]: path for path in paths}
+
+@functools.lru_cache(maxsize=512)
+def _parse_pssm_cached(pssm_path, chain_id):
+    """ Parse one PSSM file, remembering the result for subsequent calls.
+
+        Many variants refer to the same PDB entry, so caching the parsed
+        chains turns the repeated I/O and parsing into a dict lookup. The
+        parse itself goes through the on-disk cache, which persists across
+        runs of the pipeline.
+
+        Args:
+            pssm_path (str): resolved path of the PSSM file
+            chain_id (str): chain that the PSSM file describes
+
+        Returns (Pssm): the parsed PSSM data, must not be modified by the caller
+    """
+
+    return parse_pssm_cached(pssm_path, chain_id)
 
 
 def _get_pssm(chain_ids, variant, environment):
@@ -82,8 +157,8 @@ def _get_pssm(chain_ids, variant, environment):
             else:
                 raise FileNotFoundError("No PSSM for {} chain {} in {}".format(variant.pdb_ac, chain_id, environment.pssm_root))
 
-        with open(pssm_paths[chain_id], 'rt', encoding='utf_8') as f:
-            pssm.merge_with(parse_pssm(f, chain_id))
+        # Key the cache on the real path, so that relocated files don't alias.
+        pssm.merge_with(_parse_pssm_cached(os.path.realpath(pssm_paths[chain_id]), chain_id))
     return pssm
 
 
@@ -101,41 +176,60 @@ def __compute_feature__(environment, distance_cutoff, feature_group, variant):
 
     # Initialize a feature object:
     feature_object = FeatureClass("Residue")
-    feature_object.feature_data_xyz[WT_FEATURE_NAME] = {}
-    feature_object.feature_data_xyz[VAR_FEATURE_NAME] = {}
-    feature_object.feature_data_xyz[IC_FEATURE_NAME] = {}
-    for amino_acid in amino_acids:
-        feature_object.feature_data_xyz[PSSM_FEATURE_NAME + amino_acid.code] = {}
+    feature_object.declare_xyz_features([WT_FEATURE_NAME, VAR_FEATURE_NAME, IC_FEATURE_NAME] + PSSM_FEATURE_NAMES)
+
+    # Index the neighbouring atoms by residue identifier, so that the variant
+    # residue's atoms can be looked up directly instead of scanned for:
+    atoms_per_residue_id = defaultdict(list)
+    for atom in neighbour_atoms:
+        residue = atom.residue
+        atoms_per_residue_id[(residue.chain_id, residue.number, residue.insertion_code)].append(atom)
 
     # Get the variant atoms:
     residue_id = Residue(variant.residue_number, variant.wildtype_amino_acid, variant.chain_id)
-    variant_atoms = set([atom for atom in neighbour_atoms if atom.residue == residue_id])
+    variant_atoms = atoms_per_residue_id.get((variant.chain_id, variant.residue_number, variant.insertion_code), [])
     if len(variant_atoms) == 0:
         raise ValueError(f"No atoms found for {residue_id}")
 
     # Get variant probability features and place them at the C-alpha xyz position:
     if pssm.has_residue(residue_id):
-        wild_type_probability = pssm.get_probability(residue_id, variant.wild_type_amino_acid.code)
-        variant_probability = pssm.get_probability(residue_id, variant.variant_amino_acid.code)
-
-        for atom in variant_atoms:
-            xyz_key = tuple(atom.position)
-
-            feature_object.feature_data_xyz[WT_FEATURE_NAME][xyz_key] = [wild_type_probability]
-            feature_object.feature_data_xyz[VAR_FEATURE_NAME][xyz_key] = [variant_probability]
-
-    # For each neighbouring C-alpha, get the residue's PSSM features:
+        wild_type_probability = numpy.float16(pssm.get_probability(residue_id, variant.wild_type_amino_acid.code))
+        variant_probability = numpy.float16(pssm.get_probability(residue_id, variant.variant_amino_acid.code))
+
+        variant_positions = numpy.array([atom.position for atom in variant_atoms])
+        feature_object.add_xyz_batch(WT_FEATURE_NAME, variant_positions,
+                                     numpy.full((len(variant_atoms), 1), wild_type_probability))
+        feature_object.add_xyz_batch(VAR_FEATURE_NAME, variant_positions,
+                                     numpy.full((len(variant_atoms), 1), variant_probability))
+
+    # Group the neighbouring atoms per residue; the features are per-residue,
+    # so they only need to be computed once per residue and broadcast to its atoms:
+    residues_to_atoms = defaultdict(list)
     for atom in neighbour_atoms:
         if pssm.has_residue(atom.residue):
-            xyz_key = tuple(atom.position)
+            residues_to_atoms[atom.residue].append(atom)
+
+    if len(residues_to_atoms) > 0:
+        unique_residues = list(residues_to_atoms)
+
+        # Half precision is plenty for probabilities and information content
+        # that end up as CNN inputs, and the quantized values compress better:
+        probabilities = pssm.as_matrix(unique_residues, [amino_acid.code for amino_acid in amino_acids]).astype(numpy.float16)
+        information_contents = pssm.as_ic_vector(unique_residues).astype(numpy.float16)
 
-            feature_object.feature_data_xyz[IC_FEATURE_NAME][xyz_key] = [pssm.get_information_content(atom.residue)]
+        atom_counts = numpy.array([len(residues_to_atoms[residue]) for residue in unique_residues])
+        positions = numpy.fromiter((coordinate
+                                    for residue in unique_residues
+                                    for atom in residues_to_atoms[residue]
+                                    for coordinate in atom.position),
+                                   dtype=float).reshape(-1, 3)
 
-            for amino_acid in amino_acids:
-                feature_name = PSSM_FEATURE_NAME + amino_acid.code
-                feature_value = pssm.get_probability(atom.residue, amino_acid.code)
+        feature_object.add_xyz_batch(IC_FEATURE_NAME, positions,
+                                     numpy.repeat(information_contents, atom_counts).reshape(-1, 1))
 
-                feature_object.feature_data_xyz[feature_name][xyz_key] = [feature_value]
+        for column, feature_name in enumerate(PSSM_FEATURE_NAMES):
+            feature_object.add_xyz_batch(feature_name, positions,
+                                         numpy.repeat(probabilities[:, column], atom_counts).reshape(-1, 1))
 
     # Export to HDF5 file:
     feature_object.export_dataxyz_hdf5(feature_group)
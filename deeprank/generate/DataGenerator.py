@@ -5,6 +5,7 @@ import re
 import sys
 import warnings
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import traceback
 
 import h5py
@@ -38,6 +39,30 @@ except ImportError:
 def _printif(string, cond): return print(string) if cond else None
 
 
+def _create_database_part(environment, variants, align, compute_targets, compute_features,
+                          data_augmentation, hdf5_path, verbose, remove_error, prog_bar,
+                          distance_cutoff, random_seed):
+    """Worker task for DataGenerator.create_database_parallel: builds one hdf5 part file.
+
+    Runs in its own process, so the module-level caches (parsed PSSM files,
+    pdb2sql handles) are local to the worker and shared by all its variants.
+    """
+
+    generator = DataGenerator(environment, variants,
+                              align=align,
+                              compute_targets=compute_targets,
+                              compute_features=compute_features,
+                              data_augmentation=data_augmentation,
+                              hdf5=hdf5_path)
+    generator.create_database(verbose=verbose,
+                              remove_error=remove_error,
+                              prog_bar=prog_bar,
+                              distance_cutoff=distance_cutoff,
+                              random_seed=random_seed)
+
+    return generator.feature_error, generator.grid_error
+
+
 class DataGenerator(object):
 
     # In the feature dataset, the first three columns are xyz.
@@ -454,6 +479,70 @@ class DataGenerator(object):
         self.logger.info(
             f'\n# Successfully created database: {self.hdf5}\n')
 
+    def create_database_parallel(
+            self,
+            processes=None,
+            verbose=False,
+            remove_error=True,
+            prog_bar=False,
+            distance_cutoff=10.0,
+            random_seed=None):
+        """Create the database with a pool of worker processes.
+
+        The variants are grouped per pdb accession code before being handed
+        out, so that every worker receives whole pdb entries and gets maximum
+        reuse out of its process-local caches (parsed PSSM files and pdb2sql
+        handles). Each worker writes its own part file, following the same
+        naming convention as the MPI layout: 000_<name>, 001_<name>, ...
+
+        Args:
+            processes (int, optional): number of worker processes, defaults to the cpu count
+            verbose (bool, optional): Print creation details
+            remove_error (bool, optional): remove the groups that errored
+            prog_bar (bool, optional): use tqdm
+            distance_cutoff (float): max distance from center to include atoms, defaults to 10.0 Å
+            random_seed (int): random seed for getting rotation axis and angle
+
+        Returns ([str]): the paths of the hdf5 part files that were written
+        """
+
+        if processes is None:
+            processes = os.cpu_count()
+
+        # Group the variants per pdb entry, keeping the input order:
+        variants_per_pdb = OrderedDict()
+        for variant in self.variants:
+            variants_per_pdb.setdefault(variant.pdb_ac, []).append(variant)
+
+        # Deal whole pdb groups round-robin over the workers:
+        variant_parts = [[] for _ in range(processes)]
+        for index, pdb_variants in enumerate(variants_per_pdb.values()):
+            variant_parts[index % processes].extend(pdb_variants)
+        variant_parts = [part for part in variant_parts if len(part) > 0]
+
+        h5path, h5name = os.path.split(self.hdf5)
+        part_paths = [os.path.join(h5path, f"{rank:03d}_{h5name}")
+                      for rank in range(len(variant_parts))]
+
+        self.logger.info(
+            f'\n# Start creating HDF5 database over {len(part_paths)} processes: {self.hdf5}')
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_create_database_part,
+                                       self.environment, part, self.align,
+                                       self.compute_targets, self.compute_features,
+                                       self.data_augmentation, part_path,
+                                       verbose, remove_error, prog_bar,
+                                       distance_cutoff, random_seed)
+                       for part, part_path in zip(variant_parts, part_paths)]
+
+            for future in futures:
+                feature_error, grid_error = future.result()
+                self.feature_error += feature_error
+                self.grid_error += grid_error
+
+        return part_paths
+
     def aug_data(self, augmentation, keep_existing_aug=True, random_seed=None):
         """Augment exiting original PDB data and features.
 
@@ -32,6 +32,7 @@ class NormalizeData(object):
         self.parameters = {'features': {}, 'targets': {}}
         self.shape = shape
         self.fexport = os.path.splitext(self.fname)[0] + '_norm.pckl'
+        self.fexport_npz = os.path.splitext(self.fname)[0] + '_norm.npz'
         self.skip_feature = []
         self.skip_target = []
 
@@ -163,6 +164,37 @@ class NormalizeData(object):
         pickle.dump(self.parameters, f)
         f.close()
 
+        self._export_data_npz()
+
+    def _export_data_npz(self):
+        """Export the data as flat arrays in an npz file.
+
+        Loading the arrays is much faster than unpickling the nested
+        NormParam dictionaries, so this is the format that
+        DataSet._read_norm prefers.
+        """
+
+        channels, mean, var = [], [], []
+        for feat_type, feat_dict in self.parameters['features'].items():
+            for name, param in feat_dict.items():
+                channels.append('%s/%s' % (feat_type, name))
+                mean.append(param.mean)
+                var.append(param.var)
+
+        target_names = list(self.parameters['targets'].keys())
+        target_min = [self.parameters['targets'][name].min
+                      for name in target_names]
+        target_max = [self.parameters['targets'][name].max
+                      for name in target_names]
+
+        np.savez(self.fexport_npz,
+                 channels=np.array(channels),
+                 mean=np.array(mean),
+                 var=np.array(var),
+                 target_names=np.array(target_names),
+                 target_min=np.array(target_min),
+                 target_max=np.array(target_max))
+
 
 class NormParam(object):
 
@@ -1,3 +1,4 @@
+import fnmatch
 import glob
 import os
 import pickle
@@ -11,10 +12,19 @@ import numpy as np
 from tqdm import tqdm
 import pdb2sql
 
+# importing hdf5plugin registers the bitshuffle filter, needed to read
+# files repacked with scripts/repack_for_training.py --compression bitshuffle
+try:
+    import hdf5plugin  # noqa: F401
+except ImportError:
+    pass
+
+# suffix of the augmented (rotated) variants in the hdf5 files
+_ROTATION_SUFFIX = re.compile(r'_r(\d+)$')
+
 from deeprank import config
 from deeprank.config import logger
 from deeprank.generate import MinMaxParam, NormalizeData, NormParam
-from deeprank.tools import sparse
 from deeprank.operate.hdf5data import load_variant
 
 # import torch.utils.data as data_utils
@@ -34,6 +44,8 @@ class DataSet():
                  transform_to_2D=False, projection=0,
                  grid_shape=None,
                  clip_features=False, clip_factor=1.5,
+                 feature_dtype='float32',
+                 in_memory=False,
                  rotation_seed=None,
                  tqdm=False,
                  process=True):
@@ -94,6 +106,16 @@ class DataSet():
                 Default: False
             clip_factor (float, optional): the features are clipped at:
                 +/-mean + clip_factor * std
+            feature_dtype (str, optional): numpy type of the feature
+                tensor handed to pytorch. 'float16' halves the memory
+                traffic of the data pipeline; the model casts its input
+                to its own precision anyway.
+                Default: 'float32'
+            in_memory (bool, optional): preload the whole data set into
+                one contiguous array, so the hdf5 files are read exactly
+                once and every epoch is served from memory. Requires
+                enough RAM to hold all the samples.
+                Default: False
             tqdm (bool, optional): Print the progress bar
             process (bool, optional): Actually process the data set.
                 Must be set to False when reusing a model for testing
@@ -113,7 +135,6 @@ class DataSet():
             >>>                    },
             >>>                    select_target='class',
             >>>                    normalize_features = True,
-            >>>                    pair_chain_feature=None,
             >>>                    dict_filter={'class': '==0.0'},
             >>>                    process = True)
         '''
@@ -151,8 +172,20 @@ class DataSet():
         # clip the data
         self.clip_features = clip_features
         self.clip_factor = clip_factor
+
+        # in-memory type of the features
+        self.feature_dtype = feature_dtype
         logger.debug("learn with clip_features = {}, clip_factor={}".format(clip_features, clip_factor))
 
+        # preloaded copy of the data set, filled by _preload_dataset
+        self.in_memory = in_memory
+        self._preloaded_features = None
+        self._preloaded_targets = None
+
+        # memory-mapped copy of the data set, see to_memmap/use_memmap
+        self._memmap_features = None
+        self._memmap_targets = None
+
         # shape of the data
         self.input_shape = None
         self.data_shape = None
@@ -173,10 +206,73 @@ class DataSet():
         # set random seed
         self.rotation_seed = rotation_seed
 
+        # cache of open hdf5 file handles, per process
+        self._h5_handles = {}
+        self._h5_handles_pid = os.getpid()
+
         # process the data
         if process:
             self.process_dataset()
 
+    def _h5(self, fname):
+        """Get an open read-only handle on an hdf5 file.
+
+        The handle is kept open across calls, so that the thousands of
+        __getitem__ calls during training don't reopen the file and throw
+        away its chunk cache each time. The cache holds per-process
+        handles: after a DataLoader worker fork, stale parent handles are
+        discarded and each worker opens its own.
+
+        Args:
+            fname (str): hdf5 file name
+
+        Returns:
+            h5py.File: the open file
+        """
+
+        if self._h5_handles_pid != os.getpid():
+            self._h5_handles = {}
+            self._h5_handles_pid = os.getpid()
+
+        fh5 = self._h5_handles.get(fname)
+        if fh5 is None:
+            # a bigger chunk cache than the 1MB default, so consecutive
+            # samples from the same file can be served from memory
+            fh5 = h5py.File(fname, 'r',
+                            rdcc_nbytes=64 * 1024 * 1024,
+                            rdcc_nslots=1000003)
+            self._h5_handles[fname] = fh5
+        return fh5
+
+    def __del__(self):
+        if getattr(self, '_h5_handles_pid', None) == os.getpid():
+            for fh5 in self._h5_handles.values():
+                try:
+                    fh5.close()
+                except Exception:
+                    pass
+
+    def __getstate__(self):
+        """Drop the unpicklable state before pickling.
+
+        DataLoader workers receive a pickled copy of the data set under
+        the spawn start method. Open hdf5 handles, the eval-compiled
+        filter predicates and the specialized projection closure cannot
+        be pickled; their use sites all rebuild them lazily, so they
+        are simply left out here.
+        """
+
+        state = self.__dict__.copy()
+        state['_h5_handles'] = {}
+        state['_filter_predicates'] = None
+        state.pop('_convert2d_impl', None)
+        state.pop('_convert2d_proj', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._h5_handles_pid = os.getpid()
+
     @staticmethod
     def _get_database_name(database):
         """Get the list of hdf5 database file names.
@@ -255,6 +351,10 @@ class DataSet():
         if self.normalize_features:
             self.get_norm()
 
+        # load everything in memory once, if requested
+        if self.in_memory:
+            self._preload_dataset()
+
         logger.info('\n')
         logger.info("   Data Set Info:")
         logger.info(
@@ -288,22 +388,208 @@ class DataSet():
         """
         fname, mol, angle, axis = self.index_complexes[index]
 
-        features, target = self.load_one_variant(fname, mol)
+        if self._preloaded_features is not None:
+            # the preloaded tensor is already clipped/normalized, and
+            # already projected to 2D when transform was set at preload
+            features = self._preloaded_features[index]
+            target = None
+            if self._preloaded_targets is not None:
+                target = self._preloaded_targets[index]
 
-        if self.clip_features:
-            features = self._clip_feature(features)
+            if self.transform and not self._preloaded_projected:
+                features = self._convert2d_fast(features)
+        else:
+            if self._memmap_features is not None:
+                # one memcpy from the page cache replaces the hdf5
+                # chunk read and decompression
+                features = np.array(self._memmap_features[index])
+                target = None
+                if self._memmap_targets is not None:
+                    target = np.array(self._memmap_targets[index])
+            else:
+                features, target = self.load_one_variant(fname, mol)
 
-        if self.normalize_features:
-            features = self._normalize_feature(features)
+            if self.clip_features and self.normalize_features:
+                features = self._clip_norm_feature(features)
+            elif self.clip_features:
+                features = self._clip_feature(features)
+            elif self.normalize_features:
+                features = self._normalize_feature(features)
 
-        if self.transform:
-            features = self.convert2d(features, self.proj2D)
+            if self.transform:
+                features = self._convert2d_fast(features)
 
         result = {'mol': [fname, mol], 'feature': features}
         if target is not None:
             result['target'] = target
         return result
 
+    def _preload_dataset(self):
+        """Read the whole data set into one contiguous array.
+
+        Every hdf5 file is then read exactly once; the per-epoch
+        traversals in the training loop are served as zero-copy views of
+        the preloaded tensor, with clipping/normalization already
+        applied.
+        """
+
+        n = len(self.index_complexes)
+        features = np.empty((n,) + tuple(self.data_shape),
+                            dtype=self.feature_dtype)
+        targets = np.empty((n, 1), dtype=self.feature_dtype)
+        have_targets = True
+
+        logger.info(f'   Preloading {n} conformations in memory '
+                    f'({features.nbytes / 1024**2:.0f} MB)')
+
+        for position, (fname, mol, _, _) in enumerate(self.index_complexes):
+            feature, target = self.load_one_variant(fname, mol)
+            features[position] = feature
+            if target is None:
+                have_targets = False
+            elif have_targets:
+                targets[position] = target
+
+        # single pass over the whole set, the (C,1,1,1) parameter
+        # arrays broadcast over the sample axis
+        if self.clip_features and self.normalize_features:
+            features = self._clip_norm_feature(features)
+        elif self.clip_features:
+            features = self._clip_feature(features)
+        elif self.normalize_features:
+            features = self._normalize_feature(features)
+
+        # apply the 2D projection once over the whole set, so the
+        # per-sample reshape disappears from __getitem__ and the
+        # projected channels are stored contiguously
+        self._preloaded_projected = False
+        if self.transform:
+            features = np.ascontiguousarray(
+                features.reshape((n,) + tuple(self.input_shape)))
+            self._preloaded_projected = True
+
+        self._preloaded_features = features
+        self._preloaded_targets = targets if have_targets else None
+
+    @staticmethod
+    def _memmap_target_name(path):
+        """Get the name of the target file next to a feature memmap."""
+        return os.path.splitext(path)[0] + '_targets.npy'
+
+    def to_memmap(self, path):
+        """Write the raw features of the data set to a flat .npy file.
+
+        The file holds one (N,C,x,y,z) array in sample index order; the
+        targets, when every sample has one, go to a sibling
+        '<path>_targets.npy'. Loading the pair back with
+        :meth:`use_memmap` turns the random sample reads of training
+        into plain page-cache copies, with no hdf5 chunk decompression
+        and no h5py call overhead.
+
+        Args:
+            path (str): name of the .npy file to write
+        """
+
+        n = len(self.index_complexes)
+        out = np.lib.format.open_memmap(
+            path, mode='w+', dtype=self.feature_dtype,
+            shape=(n,) + tuple(self.data_shape))
+        targets = np.empty((n, 1), dtype=self.feature_dtype)
+        have_targets = True
+
+        for position, (fname, mol, _, _) in enumerate(self.index_complexes):
+            feature, target = self.load_one_variant(fname, mol)
+            out[position] = feature
+            if target is None:
+                have_targets = False
+            elif have_targets:
+                targets[position] = target
+
+        out.flush()
+        if have_targets:
+            np.save(self._memmap_target_name(path), targets)
+
+    def use_memmap(self, path):
+        """Serve the features from a file written by :meth:`to_memmap`.
+
+        Args:
+            path (str): name of the .npy file
+
+        Raises:
+            ValueError: if the file does not match the data set
+        """
+
+        features = np.load(path, mmap_mode='r')
+        expected = (len(self.index_complexes),) + tuple(self.data_shape)
+        if features.shape != expected:
+            raise ValueError(
+                f'Memmap {path} has shape {features.shape}, '
+                f'expected {expected}')
+
+        self._memmap_features = features
+        target_name = self._memmap_target_name(path)
+        if os.path.isfile(target_name):
+            self._memmap_targets = np.load(target_name, mmap_mode='r')
+
+    def get_batch(self, indices):
+        """Load a whole mini-batch of samples in one ordered traversal.
+
+        The samples are read sorted by file and variant name, so the
+        hdf5 accesses stay sequential within the batch, stacked into one
+        contiguous array, and clipped/normalized in a single pass over
+        the whole batch instead of once per sample.
+
+        The returned dict has the same layout as a default-collated
+        batch of __getitem__ items, so it plugs into pytorch directly
+        by loading from the sample indices:
+
+        >>> loader = DataLoader(list(range(len(data_set))),
+        ...                     batch_size=64, shuffle=True,
+        ...                     collate_fn=data_set.get_batch)
+
+        Args:
+            indices (list(int)): indices of the samples in the batch
+
+        Returns:
+            dict: {'mol':[fnames,mols],'feature':tensor,'target':tensor}
+        """
+        import torch
+
+        order = sorted(indices,
+                       key=lambda index: self.index_complexes[index][:2])
+
+        batch = None
+        fnames, mols, targets = [], [], []
+        for position, index in enumerate(order):
+            fname, mol, _, _ = self.index_complexes[index]
+            feature, target = self.load_one_variant(fname, mol)
+
+            if batch is None:
+                batch = np.empty((len(order),) + feature.shape,
+                                 dtype=feature.dtype)
+            batch[position] = feature
+
+            fnames.append(fname)
+            mols.append(mol)
+            if target is not None:
+                targets.append(target)
+
+        # the (C,1,1,1) parameter arrays broadcast over the batch axis too
+        if self.clip_features and self.normalize_features:
+            batch = self._clip_norm_feature(batch)
+        elif self.clip_features:
+            batch = self._clip_feature(batch)
+        elif self.normalize_features:
+            batch = self._normalize_feature(batch)
+
+        if self.transform:
+            batch = batch.reshape((len(order),) + tuple(self.input_shape))
+
+        result = {'mol': [fnames, mols], 'feature': torch.from_numpy(batch)}
+        if len(targets) == len(order):
+            result['target'] = torch.from_numpy(np.stack(targets))
+        return result
+
     @staticmethod
     def check_hdf5_files(database):
         """Check if the data contained in the hdf5 file is ok."""
@@ -358,19 +644,17 @@ class DataSet():
             if self.tqdm:
                 data_tqdm.set_postfix(mol=os.path.basename(fdata))
             try:
-                fh5 = h5py.File(fdata, 'r')
+                fh5 = self._h5(fdata)
                 mol_names = list(fh5.keys())
                 mol_names = self._select_variants(mol_names)
-                for k in mol_names:
-                    if self.filter(fh5[k]):
-                        self.index_complexes += [(fdata,
-                                                  k, None, None)]
-                        for irot in range(self.data_augmentation):
-                            axis, angle = pdb2sql.transform.get_rot_axis_angle(
-                                self.rotation_seed)
-                            self.index_complexes += [
-                                (fdata, k, angle, axis)]
-                fh5.close()
+                for k in self._filter_many(fh5, mol_names):
+                    self.index_complexes += [(fdata,
+                                              k, None, None)]
+                    for irot in range(self.data_augmentation):
+                        axis, angle = pdb2sql.transform.get_rot_axis_angle(
+                            self.rotation_seed)
+                        self.index_complexes += [
+                            (fdata, k, angle, axis)]
             except Exception:
                 logger.exception(f'Ignore file: {fdata}')
 
@@ -397,12 +681,11 @@ class DataSet():
                 if self.tqdm:
                     data_tqdm.set_postfix(mol=os.path.basename(fdata))
                 try:
-                    fh5 = h5py.File(fdata, 'r')
+                    fh5 = self._h5(fdata)
                     mol_names = list(fh5.keys())
                     mol_names = self._select_variants(mol_names)
                     self.index_complexes += [(fdata, k, None, None)
                                              for k in mol_names]
-                    fh5.close()
                 except Exception:
                     logger.exception(f'Ignore file: {fdata}')
 
@@ -426,12 +709,11 @@ class DataSet():
                 if self.tqdm:
                     data_tqdm.set_postfix(mol=os.path.basename(fdata))
                 try:
-                    fh5 = h5py.File(fdata, 'r')
+                    fh5 = self._h5(fdata)
                     mol_names = list(fh5.keys())
                     mol_names = self._select_variants(mol_names)
                     self.index_complexes += [(fdata, k, None, None)
                                              for k in mol_names]
-                    fh5.close()
                 except Exception:
                     logger.exception(f'Ignore file: {fdata}')
 
@@ -440,6 +722,72 @@ class DataSet():
             range(self.ntrain + self.nvalid, self.ntot))
         self.ntest = self.ntot - self.ntrain - self.nvalid
 
+        # sort each split by file name and variant name, so that
+        # consecutive indices read adjacent hdf5 chunks. Each split is
+        # sorted on its own to keep the index ranges above valid.
+        for index_range in (self.index_train, self.index_valid,
+                            self.index_test):
+            if index_range:
+                start, stop = index_range[0], index_range[-1] + 1
+                self.index_complexes[start:stop] = sorted(
+                    self.index_complexes[start:stop],
+                    key=lambda entry: (entry[0], entry[1]))
+
+    def chunk_cycle_order(self, indices, rng=None):
+        """Shuffle sample indices without scattering the file accesses.
+
+        The indices are grouped per hdf5 file, each group is shuffled
+        internally and the group order is shuffled, but every group stays
+        contiguous. An epoch thus still visits the samples in random
+        order, while the reads walk one file at a time instead of
+        seeking across all of them.
+
+        Args:
+            indices (list(int)): indices into the dataset
+            rng (np.random.Generator, optional): source of randomness
+
+        Returns:
+            list(int): the reordered indices
+        """
+
+        if rng is None:
+            rng = np.random.default_rng()
+
+        groups = {}
+        for index in indices:
+            fname = self.index_complexes[index][0]
+            groups.setdefault(fname, []).append(index)
+
+        group_list = list(groups.values())
+        rng.shuffle(group_list)
+
+        order = []
+        for group in group_list:
+            rng.shuffle(group)
+            order += group
+
+        return order
+
+    def chunk_cycle_sampler(self, indices=None, seed=None):
+        """Get a sampler that yields a fresh chunk-cycle order per epoch.
+
+        Usable as the ``sampler`` argument of a pytorch ``DataLoader`` in
+        place of ``SubsetRandomSampler``.
+
+        Args:
+            indices (list(int), optional): indices to sample from,
+                defaults to the whole dataset
+            seed (int, optional): random seed
+
+        Returns:
+            _ChunkCycleSampler: the sampler
+        """
+
+        if indices is None:
+            indices = list(range(len(self.index_complexes)))
+
+        return _ChunkCycleSampler(self, indices, seed)
+
     def _select_variants(self, variant_names):
         """Select complexes.
 
@@ -450,24 +798,34 @@ class DataSet():
             list: list of selected complexes
         """
 
-        fnames_original = list(
-            filter(lambda x: not re.search(r'_r\d+$', x), variant_names))
+        # one pass over the names with the precompiled pattern, instead
+        # of one filter() scan per rotation index
+        fnames_original = []
+        fnames_per_rotation = {}
+        for name in variant_names:
+            match = _ROTATION_SUFFIX.search(name)
+            if match is None:
+                fnames_original.append(name)
+            else:
+                fnames_per_rotation.setdefault(
+                    match.group(1), []).append(name)
+
         if self.use_rotation is not None:
             fnames_augmented = []
             # TODO if there is no augmentation data in dataaset,
             # the fnames_augmented should be 0, should report it.
             if self.use_rotation > 0:
                 for i in range(self.use_rotation):
-                    fnames_augmented += list(filter(lambda x:
-                                                    re.search('_r%03d$' % (i + 1), x), variant_names))
+                    fnames_augmented += fnames_per_rotation.get(
+                        '%03d' % (i + 1), [])
                 selected_variant_names = fnames_original + fnames_augmented
             else:
                 selected_variant_names = fnames_original
         else:
             selected_variant_names = variant_names
             sample_id = fnames_original[0]
-            num_rotations = len(list((filter(lambda x:
-                                re.search(sample_id + '_r', x), variant_names))))
+            num_rotations = sum(1 for name in variant_names
+                                if sample_id + '_r' in name)
             self.use_rotation = num_rotations
 
         return selected_variant_names
@@ -520,30 +878,81 @@ class DataSet():
             ValueError: If an unsuported condition is provided
         """
 
-        logger.debug("filtering {}".format(molgrp.name))
-
         if self.dict_filter is None:
             return True
 
-        for cond_name, cond_vals in self.dict_filter.items():
+        if getattr(self, '_filter_predicates', None) is None:
+            self._compile_filters()
 
-            logger.debug("filter with condition {}: {}".format(cond_name, cond_vals))
+        for cond_name, predicate in self._filter_predicates.items():
 
             if cond_name not in molgrp['targets']:
                 raise ValueError(f'Filter {cond_name} not found for mol {molgrp.name}')
 
             val = molgrp['targets/' + cond_name][()]
 
-            # if we have a string it's more complicated
-            if isinstance(cond_vals, str):
-                new_cond_vals = DataSet._insert_before_operators(cond_vals, 'val')
-                if not eval(new_cond_vals):
-                    return False
-            else:
-                raise ValueError("Conditions not supported", cond_vals)
+            if not predicate(val):
+                return False
 
         return True
 
+    def _filter_many(self, fh5, mol_names):
+        """Apply the dataset filter to all the molecules of one file.
+
+        The target scalars are collected into one array per condition
+        and the compiled predicates run on the whole array, instead of
+        evaluating per molecule.
+
+        Args:
+            fh5 (h5py.File): the open hdf5 file
+            mol_names (list(str)): names of the molecules in the file
+        Returns:
+            list(str): the names of the molecules that pass the filter
+        """
+
+        if self.dict_filter is None or len(mol_names) == 0:
+            return mol_names
+
+        if getattr(self, '_filter_predicates', None) is None:
+            self._compile_filters()
+
+        mask = np.ones(len(mol_names), dtype=bool)
+        for cond_name, predicate in self._filter_predicates.items():
+            try:
+                vals = np.fromiter(
+                    (fh5[k]['targets/' + cond_name][()] for k in mol_names),
+                    dtype=np.float32, count=len(mol_names))
+            except KeyError:
+                raise ValueError(f'Filter {cond_name} not found in {fh5.filename}')
+
+            mask &= predicate(vals)
+
+        return [mol_names[i] for i in np.nonzero(mask)[0]]
+
+    def _compile_filters(self):
+        """Compile the filter conditions of self.dict_filter into callables.
+
+        The condition strings are constant, so they are parsed and
+        compiled once here instead of eval'ed again for every molecule
+        in create_index_molecules.
+
+        Raises:
+            ValueError: If an unsuported condition is provided
+        """
+
+        self._filter_predicates = {}
+        for cond_name, cond_vals in self.dict_filter.items():
+
+            logger.debug("compile filter condition {}: {}".format(cond_name, cond_vals))
+
+            # only string conditions like '==1.0' are supported
+            if not isinstance(cond_vals, str):
+                raise ValueError("Conditions not supported", cond_vals)
+
+            expression = DataSet._insert_before_operators(cond_vals, 'val')
+            self._filter_predicates[cond_name] = eval(
+                compile('lambda val: ' + expression, '<filter>', 'eval'))
+
     def get_mapped_feature_name(self):
         """Get actual mapped feature names for feature selections.
 
@@ -560,7 +969,7 @@ class DataSet():
         """
 
         # open a h5 file in case we need it
-        f5 = h5py.File(self.train_database[0], 'r')
+        f5 = self._h5(self.train_database[0])
         mol_name = list(f5.keys())[0]
         mapped_data = f5.get(mol_name + '/mapped_features/')
 
@@ -601,31 +1010,36 @@ class DataSet():
 
                     self.select_feature[feat_type] = []
 
+                    # the available names, listed once per feature type
+                    possible_names = list(mapped_data[feat_type].keys())
+
                     # loop over all the specified feature names
                     for name in feat_names:
 
                         # if we have a wild card e.g. PSSM_*
-                        # we check the matches and add them
-                        if '*' in name:
-                            match = name.split('*')[0]
-                            possible_names = list(
-                                mapped_data[feat_type].keys())
-                            match_names = [
-                                n for n in possible_names
-                                if n.startswith(match)]
-                            self.select_feature[feat_type] += match_names
+                        # we check the matches and add them; fnmatch also
+                        # supports globs like *_sasa or pssm_?
+                        if '*' in name or '?' in name:
+                            self.select_feature[feat_type] += fnmatch.filter(
+                                possible_names, name)
 
                         # if we don't have a wild card we append
                         # <feature_name> to the list
                         else:
                             self.select_feature[feat_type] += [name]
 
-        f5.close()
+        # resolve the hdf5 paths of the selected features once; the hot
+        # loading path indexes this list instead of re-walking the
+        # select_feature dict and rebuilding the path strings per sample
+        self._feature_paths = [
+            'mapped_features/%s/%s' % (feat_type, name)
+            for feat_type, feat_names in self.select_feature.items()
+            for name in feat_names]
 
     def print_possible_features(self):
         """Print the possible features in the group."""
 
-        f5 = h5py.File(self.train_database[0], 'r')
+        f5 = self._h5(self.train_database[0])
         mol_name = list(f5.keys())[0]
         mapgrp = f5.get(mol_name + '/mapped_features/')
 
@@ -677,7 +1091,7 @@ class DataSet():
         """
 
         fname = self.train_database[0]
-        fh5 = h5py.File(fname, 'r')
+        fh5 = self._h5(fname)
         mol = list(fh5.keys())[0]
 
         # get the mol
@@ -697,8 +1111,6 @@ class DataSet():
                     f'Impossible to determine sparse grid shape.\n '
                     f'Specify argument grid_shape=(x,y,z)')
 
-            fh5.close()
-
     def get_norm(self):
         """Get the normalization values for the features."""
 
@@ -732,20 +1144,53 @@ class DataSet():
             self.target_min = self.param_norm['targets'][self.select_target].min
             self.target_max = self.param_norm['targets'][self.select_target].max
 
+            if self.target_min is not None and self.target_max is not None:
+                self._target_range = max(
+                    self.target_max - self.target_min, 1e-8)
+
+        # precompute the broadcastable arrays used on the __getitem__ hot path
+        self._set_norm_arrays()
+
+    def _set_norm_arrays(self):
+        """Precompute (C,1,1,1) arrays of the normalization parameters.
+
+        These broadcast directly against the (C,x,y,z) feature tensor,
+        so that per-item normalization is a single vectorized pass
+        instead of a Python loop over the channels.
+        """
+
+        mean = np.asarray(self.feature_mean, dtype=np.float32)
+        std = np.asarray(self.feature_std, dtype=np.float32)
+
+        self._mean4 = mean.reshape(-1, 1, 1, 1)
+        # multiply by the reciprocal instead of dividing per element
+        self._inv_std4 = (1.0 / std).reshape(-1, 1, 1, 1)
+
+        w = self.clip_factor
+        self._clip_min4 = (mean - w * std).reshape(-1, 1, 1, 1)
+        self._clip_max4 = (mean + w * std).reshape(-1, 1, 1, 1)
+
     def _read_norm(self):
         """Read or create the normalization file for the complex."""
         # loop through all the filename
         for f5 in self.train_database:
 
             # get the precalculated data
-            fdata = os.path.splitext(f5)[0] + '_norm.pckl'
+            base = os.path.splitext(f5)[0]
+            fdata = base + '_norm.pckl'
+            fnpz = base + '_norm.npz'
 
-            # if the file doesn't exist we create it
-            if not os.path.isfile(fdata):
+            # if no file exists we create it
+            if not os.path.isfile(fdata) and not os.path.isfile(fnpz):
                 logger.info(f"      Computing norm for {f5}")
                 norm = NormalizeData(f5, shape=self.grid_shape)
                 norm.get()
 
+            # prefer the flat npz arrays over unpickling NormParam trees
+            if os.path.isfile(fnpz):
+                self._add_norm_npz(fnpz, f5)
+                continue
+
             # read the data
             data = pickle.load(open(fdata, 'rb'))
 
@@ -782,20 +1227,63 @@ class DataSet():
                         (feat_types, feat))
                     self.param_norm['features'][feat_types][feat].std = 1
 
+    def _add_norm_npz(self, fnpz, f5):
+        """Accumulate the normalization parameters of one npz norm file.
+
+        Args:
+            fnpz (str): name of the npz file written by NormalizeData
+            f5 (str): name of the hdf5 file it belongs to
+        """
+
+        data = np.load(fnpz)
+        channel_index = {channel: index for index, channel
+                         in enumerate(data['channels'].tolist())}
+        means = data['mean']
+        variances = data['var']
+
+        for feat_type, feat_names in self.select_feature.items():
+            for name in feat_names:
+                index = channel_index['%s/%s' % (feat_type, name)]
+                if variances[index] == 0:
+                    logger.info(
+                        ' : STD is null for %s in %s' % (name, f5))
+                self.param_norm['features'][feat_type][name].add(
+                    float(means[index]), float(variances[index]))
+
+        if self.select_target is not None:
+            target_names = data['target_names'].tolist()
+            if self.select_target in target_names:
+                it = target_names.index(self.select_target)
+                self.param_norm['targets'][self.select_target].update(
+                    float(data['target_min'][it]))
+                self.param_norm['targets'][self.select_target].update(
+                    float(data['target_max'][it]))
+
+    def _normalize_target(self, data):
+        """Min/max normalize target values to the [0,1] range.
+
+        Args:
+            data (np.array): raw target values
+        Returns:
+            np.array: normalized target values
+        """
+
+        return (np.asarray(data, dtype=np.float32) - self.target_min) \
+            / self._target_range
+
     def backtransform_target(self, data):
         """Returns the values of the target after de-normalization.
 
         Args:
             data (list(float)): normalized data
         Returns:
-            list(float): un-normalized data
+            np.array: un-normalized data
         """
-        # print(data)
-        # print(self.target_max)
-        #data = FloatTensor(data)
-        data *= self.target_max
-        data += self.target_min
-        return data  # .numpy()
+
+        # the reverse of the min/max normalization; the old code
+        # multiplied by target_max instead of the min/max range
+        return np.asarray(data, dtype=np.float32) \
+            * self._target_range + self.target_min
 
     def _normalize_feature(self, feature):
         """Normalize the values of the features.
@@ -806,8 +1294,12 @@ class DataSet():
             np.array: normalized feature values
         """
 
-        for ic in range(self.data_shape[0]):
-            feature[ic] = (feature[ic] - self.feature_mean[ic]) / self.feature_std[ic]
+        # the arrays are not saved with a pretrained model, rebuild them
+        if not hasattr(self, '_mean4'):
+            self._set_norm_arrays()
+
+        np.subtract(feature, self._mean4, out=feature)
+        np.multiply(feature, self._inv_std4, out=feature)
         return feature
 
     def _clip_feature(self, feature):
@@ -818,12 +1310,61 @@ class DataSet():
             np.array: clipped feature values
         """
 
-        w = self.clip_factor
-        for ic in range(self.data_shape[0]):
-            minv = self.feature_mean[ic] - w * self.feature_std[ic]
-            maxv = self.feature_mean[ic] + w * self.feature_std[ic]
-            feature[ic] = np.clip(feature[ic], minv, maxv)
-            #feature[ic] = self._mad_based_outliers(feature[ic],minv,maxv)
+        # the arrays are not saved with a pretrained model, rebuild them
+        if not hasattr(self, '_clip_min4'):
+            self._set_norm_arrays()
+
+        np.clip(feature, self._clip_min4, self._clip_max4, out=feature)
+        #feature[ic] = self._mad_based_outliers(feature[ic],minv,maxv)
+        return feature
+
+    def build_input_norm_layer(self):
+        """Build a frozen BatchNorm3d layer applying the normalization.
+
+        Prepending this layer to the model moves the (x - mean) / std
+        work off the per-sample numpy path and onto the device that
+        processes the batch anyway, where it runs as one fused kernel.
+        Construct the DataSet with normalize_features=False when the
+        model uses this layer.
+
+        Returns:
+            nn.BatchNorm3d: non-trainable layer preloaded with the
+                dataset statistics, pinned to eval mode
+        """
+        import torch
+        import torch.nn as nn
+
+        layer = nn.BatchNorm3d(len(self.feature_mean),
+                               affine=False, eps=0.0, momentum=0.0)
+        with torch.no_grad():
+            layer.running_mean.copy_(torch.as_tensor(
+                self.feature_mean, dtype=torch.float32))
+            layer.running_var.copy_(torch.as_tensor(
+                self.feature_std, dtype=torch.float32) ** 2)
+
+        # keep the stored statistics in use even when the whole net is
+        # switched to training mode, which would select batch statistics
+        layer.eval()
+        layer.train = lambda mode=True: layer
+
+        return layer
+
+    def _clip_norm_feature(self, feature):
+        """Clip and normalize the features in one fused path.
+
+        The clip bounds are mean +/- clip_factor * std, so clipping
+        commutes with the normalization: normalizing first and clipping
+        the result at the scalar bounds +/- clip_factor gives the same
+        values while skipping one broadcasted pass over the tensor.
+
+        Args:
+            feature (np.array): raw feature values
+        Returns:
+            np.array: clipped and normalized feature values
+        """
+
+        feature = self._normalize_feature(feature)
+        np.clip(feature, -self.clip_factor, self.clip_factor, out=feature)
         return feature
 
     @staticmethod
@@ -868,8 +1409,9 @@ class DataSet():
         Returns:
             np.array,float: features, targets
         """
-        outtype = 'float32'
-        fh5 = h5py.File(fname, 'r')
+        # hdf5 converts on the fly when the on-disk type differs
+        outtype = getattr(self, 'feature_dtype', 'float32')
+        fh5 = self._h5(fname)
 
         if variant_name is None:
             variant_name = list(fh5.keys())[0]
@@ -883,79 +1425,138 @@ class DataSet():
         # check for mapped features:
         if 'mapped_features' not in variant_data.keys():
             logger.error(f"Error: variant: {variant_name} in {fname} does not have mapped_features ")
-            fh5.close()
             sys.exit()
 
-        # get the features
-        feature = []
-        for feat_type, feat_names in self.select_feature.items():
+        # preallocate the full (C,x,y,z) tensor and read every feature
+        # directly into its channel, instead of collecting per-feature
+        # arrays and copying them together afterwards
+        feature = np.empty(
+            (len(self._feature_paths),) + tuple(self.grid_shape), dtype=outtype)
+
+        # repacked files (scripts/repack_for_training.py) hold all the
+        # channels as one chunked dataset: one read loads the whole sample
+        stack = variant_data.get('stack')
+        if stack is not None and self._stack_usable(fname, stack):
+            stack.read_direct(feature)
+            return feature, self._load_target(variant_data, outtype)
 
-            logger.debug("selected feature: {} {}".format(feat_type, feat_names))
+        for ic, path in enumerate(self._feature_paths):
 
-            # see if the feature exists
-            if 'mapped_features/' + feat_type in variant_data.keys():
-                feat_dict = variant_data.get('mapped_features/' + feat_type)
+            data = variant_data.get(path)
+            if data is None:
+                raise ValueError(
+                    f'Feature {path} not found in file {fname} for variant '
+                    f'{variant}.\nPossible feature types are:\n\t' +
+                    '\n\t'.join(list(variant_data['mapped_features'].keys())))
+
+            # check its sparse attribute
+            # if true scatter the non-zero values into the channel,
+            # if false direct import
+            if data.attrs['sparse']:
+                # no FLANgrid object and no intermediate dense buffer
+                flat = feature[ic].reshape(-1)
+                flat[:] = 0
+                flat[data['index'][:]] = data['value'][:].reshape(-1)
             else:
-                logger.error(
-                    f'Feature type {feat_type} not found in file {fname} '
-                    f'for variant {variant_name}.\n'
-                    f'Possible feature types are:\n\t' +
-                    '\n\t'.join(
-                        list(variant_data['mapped_features'].keys()))
-                )
-                raise ValueError(feat_type, ' not supported')
+                # read straight into the channel, no intermediate array
+                data['value'].read_direct(feature[ic])
 
-            # loop through all the desired feat names
-            for name in feat_names:
+        # make sure all the feature have exact same type
+        # if they don't collate_fn in the creation of the minibatch will fail.
+        # Note returning torch.FloatTensor makes each epoch twice longer ...
+        return (feature, self._load_target(variant_data, outtype))
 
-                # extract the group
-                if name not in feat_dict:
-                    raise ValueError(f'Feature {name} not found in file {fname} for variant '
-                                     f'{variant} and feature type {feat_type}.\n'
-                                     '\n\t'.join(list(
-                                        variant_data['mapped_features/' + feat_type].keys()
-                                     )))
-
-                data = feat_dict[name]
-
-                # check its sparse attribute
-                # if true get a FLAN
-                # if flase direct import
-                if data.attrs['sparse']:
-                    mat = sparse.FLANgrid(sparse=True,
-                                          index=data['index'][:],
-                                          value=data['value'][:],
-                                          shape=self.grid_shape).to_dense()
-                else:
-                    mat = data['value'][:]
+    def _load_target(self, variant_data, outtype):
+        """Read the selected target value of one variant.
 
-                # append to the list of features
-                feature.append(mat)
+        Args:
+            variant_data (hdf5 group): group of the variant in the hdf5 file
+            outtype (str): numpy type of the returned value
 
-                logger.debug("converted feature {} {} to a {} matrix".format(feat_type, name, "x".join([str(n) for n in mat.shape])))
+        Returns:
+            np.array or None: the target value, if present
+        """
 
-        feature = np.array(feature).astype(outtype)
+        if self.select_target is not None and \
+                'targets' in variant_data and \
+                self.select_target in variant_data['targets']:
 
-        # get the target value
-        if self.select_target is not None:
+            target = variant_data['targets'][self.select_target][()]
+            return np.array([target]).astype(outtype)
 
-            if 'targets' in variant_data and self.select_target in variant_data['targets']:
-                target = variant_data['targets'][self.select_target][()]
-                logger.debug("{} has target {}".format(variant_name, target))
+        return None
 
-                target = np.array([target]).astype(outtype)
-            else:
-                target = None
-        else:
-            target = None
+    def _stack_usable(self, fname, stack):
+        """Check whether a stacked feature dataset matches the selection.
 
-        # close
-        fh5.close()
+        The stack was written with all the mapped features of the file,
+        so it can only replace the per-feature reads when the selection
+        covers exactly those channels in the same order. Files may have
+        been repacked with different channels, so the outcome is
+        remembered per file.
 
-        # make sure all the feature have exact same type
-        # if they don't collate_fn in the creation of the minibatch will fail.
-        # Note returning torch.FloatTensor makes each epoch twice longer ...
-        return (feature, target)
+        Args:
+            fname (str): name of the hdf5 file holding the stack
+            stack (hdf5 dataset): the stacked (C,x,y,z) dataset
+
+        Returns:
+            bool: True if the stack can be read directly
+        """
+
+        verdicts = getattr(self, '_stack_verdicts', None)
+        if verdicts is None:
+            verdicts = self._stack_verdicts = {}
+
+        usable = verdicts.get(fname)
+        if usable is None:
+            expected = [path[len('mapped_features/'):]
+                        for path in self._feature_paths]
+            usable = verdicts[fname] = [
+                channel for channel in stack.attrs['channels']] == expected
+
+        return usable
+
+    def _convert2d_fast(self, feature):
+        """Project one sample to 2D with a conversion specialized once.
+
+        The projection axis is constant during training, so the
+        per-call branching of convert2d is replaced by a closure doing
+        a single view-returning reshape.
+
+        Args:
+            feature (np.array): raw features
+        Returns:
+            np.array: projected features
+        """
+
+        if getattr(self, '_convert2d_proj', None) != self.proj2D:
+            self._convert2d_impl = self._make_convert2d(self.proj2D)
+            self._convert2d_proj = self.proj2D
+
+        return self._convert2d_impl(feature)
+
+    @staticmethod
+    def _make_convert2d(proj2d):
+        """Specialize convert2d for a fixed projection axis.
+
+        Args:
+            proj2d (int): projection
+        Returns:
+            callable: function mapping a (C,x,y,z) tensor to its
+                2D projection, equivalent to convert2d(feature, proj2d)
+        """
+
+        if proj2d == 0:
+            return lambda feature: feature.reshape(
+                -1, feature.shape[2], feature.shape[3])
+        elif proj2d == 1:
+            return lambda feature: feature.reshape(
+                -1, feature.shape[1], feature.shape[3])
+        elif proj2d == 2:
+            return lambda feature: feature.reshape(
+                -1, feature.shape[1], feature.shape[2])
+
+        raise ValueError('Projection %s not recognized' % proj2d)
 
     @staticmethod
     def convert2d(feature, proj2d):
@@ -1044,3 +1645,23 @@ class DataSet():
         # print(np.allclose(dgrid,dd))
 
         return dd
+
+
+class _ChunkCycleSampler():
+    """Sampler yielding dataset indices in chunk-cycle order.
+
+    Not subclassing torch's Sampler, for the same reason DataSet does
+    not subclass Dataset; any iterable with a length is accepted by the
+    DataLoader.
+    """
+
+    def __init__(self, data_set, indices, seed=None):
+        self.data_set = data_set
+        self.indices = indices
+        self.rng = np.random.default_rng(seed)
+
+    def __iter__(self):
+        return iter(self.data_set.chunk_cycle_order(self.indices, self.rng))
+
+    def __len__(self):
+        return len(self.indices)
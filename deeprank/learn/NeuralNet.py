@@ -1,15 +1,14 @@
 #!/usr/bin/env python
+import inspect
 import os
 import sys
 import time
 import logging
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 import h5py
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mtick
 import numpy as np
 import warnings
 
@@ -24,10 +23,53 @@ from torchsummary import summary
 from deeprank.operate.hdf5data import load_variant, get_variant_group_name
 from deeprank.config import logger
 from deeprank.learn import DataSet, classMetrics, rankingMetrics
-from torch.autograd import Variable
 from deeprank.models.metrics import MetricsExporterCollection, MetricsExporter
 
-matplotlib.use('agg')
+
+class _CUDAPrefetcher:
+
+    def __init__(self, data_loader, device):
+        """Iterate over a DataLoader while staging batches on the GPU.
+
+        The next batch is copied to the device on a side stream while the
+        current batch is being trained on, so the host-to-device transfer
+        overlaps with compute instead of leaving the GPU idle between
+        batches.
+
+        Args:
+            data_loader (torch.DataLoader): loader producing batch dicts
+            device (torch.device): cuda device to copy the tensors to
+        """
+        self._data_loader = data_loader
+        self._device = device
+        self._stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self._data_loader)
+
+    def __iter__(self):
+        iterator = iter(self._data_loader)
+        next_batch = self._preload(iterator)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self._device)
+            current_stream.wait_stream(self._stream)
+            batch = next_batch
+            for value in batch.values():
+                if isinstance(value, torch.Tensor):
+                    value.record_stream(current_stream)
+            next_batch = self._preload(iterator)
+            yield batch
+
+    def _preload(self, iterator):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self._stream):
+            for key, value in batch.items():
+                if isinstance(value, torch.Tensor):
+                    batch[key] = value.to(self._device, non_blocking=True)
+        return batch
 
 
 class NeuralNet():
@@ -37,6 +79,8 @@ class NeuralNet():
                  class_weights = None,
                  pretrained_model=None,
                  cuda=False, ngpu=0,
+                 mixed_precision=False,
+                 compile_model=False,
                  metrics_exporters: List[MetricsExporter] = None):
         """Train a Convolutional Neural Network for DeepRank.
 
@@ -77,6 +121,16 @@ class NeuralNet():
 
             ngpu (int): number of GPU to be used.
 
+            mixed_precision (bool): run the forward/backward passes in
+                automatic mixed precision (fp16 with gradient scaling).
+                Roughly doubles conv throughput on tensor-core GPUs.
+                Only applies when cuda is True.
+
+            compile_model (bool): compile the network with torch.compile.
+                The input shape is fixed for the whole run, so the
+                compiled kernels are generated once and reused. Needs
+                PyTorch >= 2.0; ignored otherwise.
+
             metrics_exporters: to be used for output during the run
 
         Raises:
@@ -161,6 +215,19 @@ class NeuralNet():
         if self.ngpu == 0 and self.cuda:
             self.ngpu = 1
 
+        # device of the model; batches are moved there in _get_variables
+        self.device = torch.device("cuda" if self.cuda else "cpu")
+
+        # mixed precision training: autocast in _epoch, with the scaler
+        # keeping fp16 gradients from underflowing
+        self.mixed_precision = mixed_precision and self.cuda
+        if hasattr(torch.amp, 'GradScaler'):
+            self.scaler = torch.amp.GradScaler(self.device.type,
+                                               enabled=self.mixed_precision)
+        else:
+            # the device-agnostic scaler only exists from torch 2.3 on
+            self.scaler = torch.cuda.amp.GradScaler(enabled=self.mixed_precision)
+
         # ------------------------------------------
         # Regression or classifiation
         # ------------------------------------------
@@ -184,6 +251,14 @@ class NeuralNet():
         # ------------------------------------------
         self._metrics_output = MetricsExporterCollection(*metrics_exporters)
 
+        # the exporters write plots/tables/tensorboard events; run them
+        # on a single background thread so they don't stall the next
+        # epoch, serialized to keep each exporter single-threaded. The
+        # executor is created on first use and shut down when the
+        # metrics are drained at the end of a run.
+        self._metrics_executor = None
+        self._metrics_futures = []
+
         # ------------------------------------------
         # Network
         # ------------------------------------------
@@ -193,13 +268,9 @@ class NeuralNet():
 
         # print model summary
         sys.stdout.flush()
-        if cuda is True:
-            device = torch.device("cuda")  # PyTorch v0.4.0
-        else:
-            device = torch.device("cpu")
-        summary(self.net.to(device),
+        summary(self.net.to(self.device),
                 self.data_set.input_shape,
-                device=device.type)
+                device=self.device.type)
         sys.stdout.flush()
 
         # load parameters of pretrained model if provided
@@ -215,14 +286,39 @@ class NeuralNet():
                     del self.state['state_dict'][paramname]
             self.load_model_params()
 
-        # multi-gpu
+        # multi-gpu. DataParallel replicates the model and gathers on
+        # GPU 0 every forward pass; NeuralNetDDP scales much better
+        # across several GPUs
         if self.ngpu > 1:
+            logger.warning('using nn.DataParallel for ngpu > 1; '
+                           'consider NeuralNetDDP for multi-GPU training')
             ids = [i for i in range(self.ngpu)]
             self.net = nn.DataParallel(self.net, device_ids=ids).cuda()
         # cuda compatible
         elif self.cuda:
             self.net = self.net.cuda()
 
+        if self.cuda:
+            # the input shape is fixed for the whole run, so cudnn can
+            # safely benchmark its algorithms; tf32 speeds up fp32 convs
+            # on ampere and later at negligible accuracy cost
+            torch.backends.cudnn.benchmark = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.backends.cuda.matmul.allow_tf32 = True
+
+            # 3d conv kernels prefer the channels-last memory layout
+            if model_type == '3d':
+                self.net = self.net.to(
+                    memory_format=torch.channels_last_3d)
+
+        if compile_model and hasattr(torch, 'compile'):
+            # shapes never change, so disable the dynamic-shape guards;
+            # the compilation cost is paid on the first batch of epoch 0
+            self.net = torch.compile(
+                self.net,
+                dynamic=False,
+                mode='max-autotune' if self.cuda else 'default')
+
         # set the optimizer to None in the beginning.
         # if the user is going to train a model, then he must set it.
         self.optimizer = None
@@ -365,13 +461,16 @@ class NeuralNet():
         # load data
         index = list(range(self.data_set.__len__()))
         sampler = data_utils.sampler.SubsetRandomSampler(index)
-        loader = data_utils.DataLoader(self.data_set, sampler=sampler)
+        loader = data_utils.DataLoader(self.data_set, sampler=sampler,
+                                       pin_memory=self.cuda)
 
         # do test
         with self._metrics_output:
 
             self._epoch(0, "test", loader, False)
 
+            self._drain_metrics()
+
     def save_model(self, filename='model.pth.tar'):
         """save the model to disk.
 
@@ -410,14 +509,21 @@ class NeuralNet():
 
         # guess the optimizer
         if 'momentum' in self.state['optimizer']['param_groups']:
-            self.optimizer = optim.SGD(self.net.parameters(),
-                                       lr=0.005,
-                                       momentum=0.9,
-                                       weight_decay=0.001)
+            optimizer_class = optim.SGD
+            optimizer_kwargs = {'lr': 0.005, 'momentum': 0.9,
+                                'weight_decay': 0.001}
         else:
-            self.optimizer = optim.AdamW(self.net.parameters(),
-                                         lr=0.005,
-                                         weight_decay=0.001)
+            optimizer_class = optim.AdamW
+            optimizer_kwargs = {'lr': 0.005, 'weight_decay': 0.001}
+
+        # on GPU the fused implementations update all the parameter
+        # tensors in a single kernel per step; torch before 2.0 doesn't
+        # take the keyword
+        if self.cuda and 'fused' in inspect.signature(optimizer_class).parameters:
+            optimizer_kwargs['fused'] = True
+
+        self.optimizer = optimizer_class(self.net.parameters(),
+                                         **optimizer_kwargs)
 
         self.optimizer.load_state_dict(self.state['optimizer'])
 
@@ -529,14 +635,20 @@ class NeuralNet():
         if self.cuda:
             pin = True
 
-        # create the sampler
-        train_sampler = data_utils.sampler.SubsetRandomSampler(index_train)
-        valid_sampler = data_utils.sampler.SubsetRandomSampler(index_valid)
-        test_sampler = data_utils.sampler.SubsetRandomSampler(index_test)
+        # worker options, only valid when batches are prepared in
+        # subprocesses. The workers are kept alive between epochs and each
+        # one opens its own hdf5 handles lazily (DataSet._h5), so forked
+        # processes never share a handle.
+        loader_kwargs = {}
+        if num_workers > 0:
+            loader_kwargs['num_workers'] = num_workers
+            loader_kwargs['persistent_workers'] = True
+            if prefetch_factor is not None:
+                loader_kwargs['prefetch_factor'] = prefetch_factor
 
         # get if we test as well
-        _valid_ = len(valid_sampler.indices) > 0
-        _test_ = len(test_sampler.indices) > 0
+        _valid_ = len(index_valid) > 0
+        _test_ = len(index_test) > 0
 
         # containers for the losses
         self.losses = {'train': []}
@@ -545,36 +657,33 @@ class NeuralNet():
         if _test_:
             self.losses['test'] = []
 
-        #  create the loaders
+        #  create the loaders over views of the data set. The training
+        #  loader shuffles internally with one torch.randperm per epoch;
+        #  valid/test have nothing to gain from shuffling and iterate
+        #  sequentially
         train_loader = data_utils.DataLoader(
-            self.data_set,
+            data_utils.Subset(self.data_set, index_train),
             batch_size=train_batch_size,
-            sampler=train_sampler,
             pin_memory=pin,
-            num_workers=num_workers,
-            prefetch_factor=prefetch_factor,
-            shuffle=False,
-            drop_last=True)
+            shuffle=True,
+            drop_last=True,
+            **loader_kwargs)
         if _valid_:
             valid_loader = data_utils.DataLoader(
-                self.data_set,
+                data_utils.Subset(self.data_set, index_valid),
                 batch_size=train_batch_size,
-                sampler=valid_sampler,
                 pin_memory=pin,
-                num_workers=num_workers,
-                prefetch_factor=prefetch_factor,
                 shuffle=False,
-                drop_last=True)
+                drop_last=False,
+                **loader_kwargs)
         if _test_:
             test_loader = data_utils.DataLoader(
-                self.data_set,
+                data_utils.Subset(self.data_set, index_test),
                 batch_size=train_batch_size,
-                sampler=test_sampler,
                 pin_memory=pin,
-                num_workers=num_workers,
-                prefetch_factor=prefetch_factor,
                 shuffle=False,
-                drop_last=True)
+                drop_last=False,
+                **loader_kwargs)
 
         # min error to kee ptrack of the best model.
         min_error = {'train': float('Inf'),
@@ -646,6 +755,28 @@ class NeuralNet():
                 if save_model == 'all':
                     self.save_model(filename="model_epoch_%04d.pth.tar" % epoch)
 
+            # finish the pending exports before the exporters close
+            self._drain_metrics()
+
+    def _drain_metrics(self):
+        """Wait for the pending background metric exports.
+
+        Called before leaving the metrics-output context, so that every
+        epoch is written out and any exporter error surfaces here
+        instead of being lost with the thread. The executor is shut
+        down first, so that no export is still running when the
+        exporters close, even when one of them raised, and no worker
+        thread outlives the run.
+        """
+
+        futures, self._metrics_futures = self._metrics_futures, []
+        executor, self._metrics_executor = self._metrics_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+        for future in futures:
+            future.result()
+
     @staticmethod
     def _read_entry_names(batch):
         entry_names = []
@@ -673,76 +804,123 @@ class NeuralNet():
             dict:  data of the epoch
         """
 
-        sum_of_losses = 0.0
+        # accumulated on the device; synced to the host once per epoch
+        sum_of_losses = torch.zeros((), device=self.device)
         count_data_entries = 0
         debug_time = False
         time_learn = 0
 
         # set train/eval mode
         self.net.train(mode=train_model)
-        torch.set_grad_enabled(train_model)
 
         mini_batch = 0
 
+        # on GPU, copy the batches over on a side stream so that the
+        # transfer of batch N+1 overlaps with the compute of batch N
+        if self.cuda:
+            data_loader = _CUDAPrefetcher(data_loader, self.device)
+
         batch_count = len(data_loader)
         logger.info("running epoch {} on {} batches".format(epoch_number, batch_count))
 
         entry_names = []
-        output_values = []
-        target_values = []
-
-        for batch_index, batch in enumerate(data_loader):
-
-            mini_batch = mini_batch + 1
-
-            logger.info(f"\t\t-> mini-batch: {mini_batch} ")
-
-            # get the data
-            inputs = batch['feature']
-            if 'target' in batch:
-                targets = batch['target']
-            else:
-                targets = None
-            entry_names += self._read_entry_names(batch)
-
-            # transform the data
-            inputs, targets = self._get_variables(inputs, targets)
-
-            # starting time
-            tlearn0 = time.time()
-
-            # forward
-            outputs = self.net(inputs)
 
-            # class complains about the shape ...
-            if self.task == 'class' and targets is not None:
-                targets = targets.view(-1)
-
-            # evaluate loss
-            if targets is not None:
-                batch_loss = self.criterion(outputs, targets)
-
-                sum_of_losses += batch_loss.detach().item() * outputs.shape[0]
-            count_data_entries += outputs.shape[0]
-
-            # zero + backward + step
-            if train_model:
-                self.optimizer.zero_grad()
-                batch_loss.backward()
-                self.optimizer.step()
-            time_learn += time.time() - tlearn0
-
-            output_values += outputs.tolist()
-
-            if targets is not None:
-                target_values += targets.tolist()
-            else:
-                target_values += [-1] * outputs.shape[0]
+        # epoch-wide result buffers, allocated on the first batch once
+        # the output dimensions are known (the first batch is the
+        # largest, so batch_count * its size bounds the entry count)
+        output_buffer = None
+        target_buffer = None
+        filled = 0
+
+        # eval passes run without autograd bookkeeping; the context
+        # restores the caller's grad mode afterwards
+        with torch.set_grad_enabled(train_model):
+            for batch_index, batch in enumerate(data_loader):
+
+                mini_batch = mini_batch + 1
+
+                logger.info(f"\t\t-> mini-batch: {mini_batch} ")
+
+                # get the data
+                inputs = batch['feature']
+                if 'target' in batch:
+                    targets = batch['target']
+                else:
+                    targets = None
+                entry_names += self._read_entry_names(batch)
+
+                # transform the data
+                inputs, targets = self._get_variables(inputs, targets)
+
+                # starting time
+                tlearn0 = time.time()
+
+                # forward + loss, in reduced precision when requested
+                with torch.autocast(device_type=self.device.type,
+                                    enabled=self.mixed_precision):
+                    outputs = self.net(inputs)
+
+                    # class complains about the shape ...
+                    if self.task == 'class' and targets is not None:
+                        targets = targets.view(-1)
+
+                    # evaluate loss
+                    if targets is not None:
+                        batch_loss = self.criterion(outputs, targets)
+
+                if targets is not None:
+                    # no .item() here: that would block on the GPU every batch
+                    sum_of_losses += batch_loss.detach() * outputs.shape[0]
+                count_data_entries += outputs.shape[0]
+
+                # zero + backward + step; the scaler is a no-op when mixed
+                # precision is off
+                if train_model:
+                    # set_to_none skips the memset over every grad tensor
+                    self.optimizer.zero_grad(set_to_none=True)
+                    self.scaler.scale(batch_loss).backward()
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                time_learn += time.time() - tlearn0
+
+                # copy the batch results into the preallocated host
+                # buffers; the python float conversion happens once at
+                # the end of the epoch
+                n = outputs.shape[0]
+                if output_buffer is None:
+                    capacity = batch_count * n
+                    output_buffer = torch.empty(
+                        (capacity,) + tuple(outputs.shape[1:]),
+                        dtype=outputs.dtype)
+                output_buffer[filled:filled + n].copy_(outputs.detach())
+
+                if targets is not None:
+                    if target_buffer is None:
+                        target_buffer = torch.empty(
+                            (capacity,) + tuple(targets.shape[1:]),
+                            dtype=targets.dtype)
+                    target_buffer[filled:filled + n].copy_(targets.detach())
+                filled += n
+
+        if output_buffer is not None:
+            output_values = output_buffer[:filled].tolist()
+        else:
+            output_values = []
+        if target_buffer is not None:
+            target_values = target_buffer[:filled].tolist()
+        else:
+            target_values = [-1] * filled
 
-        self._metrics_output.process(pass_name, epoch_number, entry_names, output_values, target_values)
+        # export in the background; the lists are built fresh every epoch
+        # so the training loop never mutates what the thread is writing
+        if self._metrics_executor is None:
+            self._metrics_executor = ThreadPoolExecutor(max_workers=1)
+        self._metrics_futures.append(self._metrics_executor.submit(
+            self._metrics_output.process, pass_name, epoch_number,
+            entry_names, output_values, target_values))
 
         if count_data_entries > 0:
-            epoch_loss = sum_of_losses / count_data_entries
+            epoch_loss = sum_of_losses.item() / count_data_entries
         else:
             epoch_loss = 0.0
 
@@ -750,34 +928,33 @@ class NeuralNet():
 
     def _get_variables(self, inputs, targets):
         # xue: why not put this step to DataSet.py?
-        """Convert the feature/target in torch.Variables.
+        """Move the feature/target tensors to the device of the model.
 
         The format is different for regression where the targets are float
         and classification where they are int.
 
         Args:
-            inputs (np.array): raw features
-            targets (np.array): raw target values
+            inputs (torch.Tensor): raw features
+            targets (torch.Tensor): raw target values
 
         Returns:
-            torch.Variable: features
-            torch.Variable: target values
+            torch.Tensor: features
+            torch.Tensor: target values
         """
 
-        # if cuda is available
-        if self.cuda:
-            inputs = inputs.cuda(non_blocking=True)
-            if targets is not None:
-                targets = targets.cuda(non_blocking=True)
-
-        # get the varialbe as float by default
-        inputs = Variable(inputs).float()
+        # with pinned batches the copy overlaps with compute thanks
+        # to non_blocking
+        inputs = inputs.to(self.device, non_blocking=True).float()
         if targets is not None:
-            targets = Variable(targets).float()
+            targets = targets.to(self.device, non_blocking=True)
+            if self.task == 'class':
+                targets = targets.long()
+            else:
+                targets = targets.float()
 
-        # change the targets to long for classification
-        if self.task == 'class' and targets is not None:
-            targets = targets.long()
+        # match the layout of the model weights (see __init__)
+        if self.cuda and inputs.dim() == 5:
+            inputs = inputs.contiguous(memory_format=torch.channels_last_3d)
 
         return inputs, targets
 
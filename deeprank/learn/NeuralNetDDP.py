@@ -5,6 +5,8 @@ import logging
 
 import h5py
 import matplotlib
+# select the headless backend before pyplot initializes a GUI one
+matplotlib.use('agg')
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mtick
 import numpy as np
@@ -22,10 +24,7 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 
 from deeprank.config import logger
 from deeprank.learn import DataSet, classMetrics, rankingMetrics
-from torch.autograd import Variable 
-
-
-matplotlib.use('agg')
+from torch.autograd import Variable
 
 
 class NeuralNetDDP():
@@ -420,11 +419,21 @@ class NeuralNetDDP():
         if self.cuda:
             pin = True
 
-        train_sampler = data_utils.sampler.SubsetRandomSampler(index_train)
+        train_subset = data_utils.Subset(self.data_set, index_train)
+
+        # shard the training samples over the DDP ranks; without this
+        # every rank would train on the full set each epoch and the
+        # gradient averaging would buy nothing
+        if dist.is_initialized():
+            train_sampler = data_utils.distributed.DistributedSampler(
+                train_subset)
+        else:
+            train_sampler = data_utils.sampler.RandomSampler(train_subset)
+
         valid_sampler = data_utils.sampler.SubsetRandomSampler(index_valid)
         test_sampler = data_utils.sampler.SubsetRandomSampler(index_test)
-        _valid_ = len(valid_sampler.indices) > 0
-        _test_ = len(test_sampler.indices) > 0
+        _valid_ = len(index_valid) > 0
+        _test_ = len(index_test) > 0
 
         self.losses = {'train': []}
         if _valid_:
@@ -442,7 +451,7 @@ class NeuralNetDDP():
                     self.classmetrics[i]['test'] = []
 
         train_loader = data_utils.DataLoader(
-            self.data_set,
+            train_subset,
             batch_size=train_batch_size,
             sampler=train_sampler,
             pin_memory=pin,
@@ -475,6 +484,12 @@ class NeuralNetDDP():
         av_time = 0.0
         self.data = {}
         for epoch in range(nepoch):
+            # reseed the shard permutation, otherwise every epoch
+            # presents the ranks with the same ordering
+            if isinstance(train_sampler,
+                          data_utils.distributed.DistributedSampler):
+                train_sampler.set_epoch(epoch)
+
             logger.info(f'\n: epoch {epoch:03d} / {nepoch:03d} {"-"*45}')
             t0 = time.time()
             logger.info(f"\n\t=> train the model\n")
@@ -704,18 +719,22 @@ class NeuralNetDDP():
         color_plot = ['red', 'blue', 'green']
         labels = ['Train', 'Valid', 'Test']
 
-        fig, ax = plt.subplots()
+        # reuse one figure across exports instead of allocating and
+        # tearing down the canvas every time
+        if not hasattr(self, '_loss_fig'):
+            self._loss_fig, self._loss_ax = plt.subplots()
+        fig, ax = self._loss_fig, self._loss_ax
+        ax.clear()
         for ik, name in enumerate(self.losses):
-            plt.plot(np.array(self.losses[name]),
-                     c = color_plot[ik],
-                     label = labels[ik])
+            ax.plot(np.array(self.losses[name]),
+                    c = color_plot[ik],
+                    label = labels[ik])
 
         legend = ax.legend(loc='upper left')
         ax.set_xlabel('Epoch')
         ax.set_ylabel('Losses')
 
         fig.savefig(figname)
-        plt.close()
 
         fname = os.path.join(self.outdir, "test.hdf5")
         self.f5 = h5py.File(f"{fname}-{self.rank}", 'w')
@@ -894,7 +913,10 @@ class NeuralNetDDP():
         """
         hdf5='epoch_data.hdf5'
         fname = os.path.join(self.outdir, hdf5)
-        self.f5 = h5py.File(fname, 'w')
+        # latest file format and a bigger chunk cache make the streaming
+        # writes cheaper than the default layout
+        self.f5 = h5py.File(fname, 'w', libver='latest',
+                            rdcc_nbytes=64 * 1024 * 1024)
         grp_name = 'epoch_%04d' % epoch
         grp = self.f5.create_group(grp_name)
         grp.attrs['type'] = 'epoch'
@@ -906,8 +928,21 @@ class NeuralNetDDP():
                     if data_name == 'mol':
                         string_dt = h5py.special_dtype(vlen=str)
                         sg.create_dataset(
-                            data_name, data=data_value, dtype=string_dt)
+                            data_name, data=data_value, dtype=string_dt,
+                            chunks=True, compression='lzf')
                     else:
-                        sg.create_dataset(data_name, data=data_value)
+                        data_value = np.asarray(data_value)
+                        if data_value.ndim > 0 and data_value.size > 0:
+                            # chunked + lzf so the write streams out
+                            # instead of building one contiguous blob
+                            sg.create_dataset(data_name, data=data_value,
+                                              chunks=True,
+                                              compression='lzf')
+                        else:
+                            # scalars (class metrics) cannot be chunked
+                            sg.create_dataset(data_name, data=data_value)
             except TypeError:
                 logger.exception("Error in exporting epoch information to hdf5 file")
+
+        # push the buffers out so external readers can follow the run
+        self.f5.flush()
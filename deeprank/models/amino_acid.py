@@ -1,6 +1,13 @@
 
 
 class AminoAcid:
+
+    # All amino acids are module-level singletons, defined in
+    # deeprank.domain.amino_acid. Comparing and hashing by object identity
+    # skips the string hashing that name-based equality would cost in
+    # sets and dicts, and __slots__ keeps the instances small.
+    __slots__ = ("name", "code", "letter")
+
     def __init__(self, name, code, letter):
         self.name = name
         self.code = code
@@ -9,8 +16,11 @@ class AminoAcid:
     def __repr__(self):
         return self.name
 
-    def __eq__(self, other):
-        return self.name == other.name
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
 
-    def __hash__(self):
-        return hash(self.name)
+    def __reduce__(self):
+        # Unpickle back to the module-level singleton where possible, so that
+        # identity comparison keeps working across process boundaries.
+        from deeprank.domain.amino_acid import _restore_amino_acid
+        return _restore_amino_acid, (self.name, self.code, self.letter)
@@ -1,3 +1,35 @@
+import numpy
+
+
+def _residue_key(residue_id):
+    """ Pack the residue identity into a single integer.
+
+        The packing covers the chain id and residue number, matching the
+        equality semantics of the Residue class. Integers are among the
+        cheapest dict keys in CPython, so the per-lookup cost stays minimal.
+
+        Args:
+            residue_id (Residue, unique): identifier of the residue in the protein
+
+        Returns (int): the packed key
+    """
+
+    key = 0
+    for character in residue_id.chain_id:
+        key = (key << 8) | ord(character)
+
+    try:
+        number = int(residue_id.number)
+    except (TypeError, ValueError):
+        # old-format pssm files keep the residue number as a raw string,
+        # which may carry an insertion code, like "25A"; fold the
+        # characters into the key instead of aborting
+        for character in str(residue_id.number):
+            key = (key << 8) | ord(character)
+
+        return key << 32
+
+    return (key << 32) | (number & 0xffffffff)
 
 
 class _PssmRecord:
@@ -10,7 +42,8 @@ class Pssm:
     "This object stores pssm data"
 
     def __init__(self):
-        self._residue_records = {}  # the keys should be residue identifiers
+        self._residue_records = {}  # keyed by packed residue keys
+        self._residues_by_key = {}  # maps the packed keys back to residue identifiers
 
     def set_amino_acid_value(self, residue_id, amino_acid, value):
         """ Set data to the pssm object for one specific amino acid on this specific residue position
@@ -21,10 +54,12 @@ class Pssm:
               value (float): specific for this amino acid on this position
         """
 
-        if residue_id not in self._residue_records:
-            self._residue_records[residue_id] = _PssmRecord()
+        key = _residue_key(residue_id)
+        if key not in self._residue_records:
+            self._residue_records[key] = _PssmRecord()
+            self._residues_by_key[key] = residue_id
 
-        self._residue_records[residue_id].amino_acid_values[amino_acid] = value
+        self._residue_records[key].amino_acid_values[amino_acid] = value
 
     def set_information_content(self, residue_id, value):
         """ Set information content to the pssm object for one specific residue_position
@@ -34,22 +69,26 @@ class Pssm:
                 value (float): information content, specific for this position
         """
 
-        if residue_id not in self._residue_records:
-            self._residue_records[residue_id] = _PssmRecord()
+        key = _residue_key(residue_id)
+        if key not in self._residue_records:
+            self._residue_records[key] = _PssmRecord()
+            self._residues_by_key[key] = residue_id
 
-        self._residue_records[residue_id].information_content = value
+        self._residue_records[key].information_content = value
 
     def merge_with(self, other):
         new = Pssm()
         new._residue_records = self._residue_records
+        new._residues_by_key = self._residues_by_key
         new._residue_records.update(other._residue_records)
+        new._residues_by_key.update(other._residues_by_key)
 
         return new
 
     def has_residue(self, residue_id):
         "True if this object has data on the given residue, False if not"
 
-        return residue_id in self._residue_records
+        return _residue_key(residue_id) in self._residue_records
 
     def get_probability(self, residue_id, amino_acid_letter):
         """ Get the pssm's probability value of the given amino acid at the given residue position
@@ -59,10 +98,11 @@ class Pssm:
                 amino_acid_letter (str): three-letter code of the amino acid
         """
 
-        if residue_id not in self._residue_records:
+        key = _residue_key(residue_id)
+        if key not in self._residue_records:
             raise ValueError("No such residue: {}".format(residue_id))
 
-        return self._residue_records[residue_id].amino_acid_values[amino_acid_letter]
+        return self._residue_records[key].amino_acid_values[amino_acid_letter]
 
     def get_information_content(self, residue_id):
         """ Get the pssm's information content for a specific residue position
@@ -71,13 +111,54 @@ class Pssm:
                 residue_id (Residue, unique): identifier of the residue in the protein
         """
 
-        if residue_id not in self._residue_records:
+        key = _residue_key(residue_id)
+        if key not in self._residue_records:
             raise ValueError("No such residue: {}".format(residue_id))
 
-        return self._residue_records[residue_id].information_content
+        return self._residue_records[key].information_content
+
+    def as_matrix(self, residue_ids, amino_acid_codes):
+        """ Get the pssm's probability values for multiple residues in one batch
+
+            Args:
+                residue_ids ([Residue]): identifiers of the residues in the protein
+                amino_acid_codes ([str]): three-letter codes of the amino acids, determines the column order
+
+            Returns (numpy array of shape (number of residues, number of amino acids)): the probability values
+        """
+
+        matrix = numpy.empty((len(residue_ids), len(amino_acid_codes)))
+        for index, residue_id in enumerate(residue_ids):
+            key = _residue_key(residue_id)
+            if key not in self._residue_records:
+                raise ValueError("No such residue: {}".format(residue_id))
+
+            amino_acid_values = self._residue_records[key].amino_acid_values
+            for column, code in enumerate(amino_acid_codes):
+                matrix[index, column] = amino_acid_values[code]
+
+        return matrix
+
+    def as_ic_vector(self, residue_ids):
+        """ Get the pssm's information content for multiple residues in one batch
+
+            Args:
+                residue_ids ([Residue]): identifiers of the residues in the protein
+
+            Returns (numpy array of shape (number of residues,)): the information content values
+        """
+
+        keys = [_residue_key(residue_id) for residue_id in residue_ids]
+        for key, residue_id in zip(keys, residue_ids):
+            if key not in self._residue_records:
+                raise ValueError("No such residue: {}".format(residue_id))
+
+        return numpy.array([self._residue_records[key].information_content
+                            for key in keys], dtype=float)
 
     def items(self):
-        return self._residue_records.items()
+        return [(self._residues_by_key[key], record)
+                for key, record in self._residue_records.items()]
 
     def __len__(self):
         return len(self._residue_records)
@@ -1,8 +1,9 @@
+from collections import OrderedDict
 import logging
 import os
 
 import numpy
-from scipy.spatial import distance_matrix
+from scipy.spatial import cKDTree
 
 from deeprank.models.pair import Pair
 from deeprank.models.atom import Atom
@@ -49,12 +50,67 @@ def get_atoms(pdb2sql):
         Returns ([Atom]): all the atoms in the pdb file.
     """
 
+    return get_atoms_with_positions(pdb2sql)[0]
+
+
+# Atom graphs per open pdb structure, kept in access order so that the
+# least recently used entry can be dropped first:
+_atom_cache = OrderedDict()
+_ATOM_CACHE_SIZE = 8
+
+
+def get_atoms_with_positions(pdb2sql):
+    """ Builds a list of atom objects plus one contiguous position array,
+        both from a single query on the pdb structure.
+
+        The result is cached per pdb2sql object, so that iterating many
+        variants over the same open structure only allocates the Atom and
+        Residue objects once. Callers must treat the returned list and
+        array as read-only. Closing a pdb structure should be paired with
+        a call to forget_atoms, so that its atom graph can be freed.
+
+        Args:
+            pdb2sql (pdb2sql object): the pdb structure that we're investigating
+
+        Returns ([Atom], numpy array of shape (number of atoms, 3)): all the atoms
+            in the pdb file and their xyz positions, in matching order
+    """
+
+    if pdb2sql in _atom_cache:
+        _atom_cache.move_to_end(pdb2sql)
+        return _atom_cache[pdb2sql]
+
+    result = _build_atoms_with_positions(pdb2sql)
+
+    _atom_cache[pdb2sql] = result
+    while len(_atom_cache) > _ATOM_CACHE_SIZE:
+        _atom_cache.popitem(last=False)
+
+    return result
+
+
+def forget_atoms(pdb2sql):
+    """ Drops the atom graph that was cached for the given pdb structure,
+        if any. Call this when closing the structure.
+
+        Args:
+            pdb2sql (pdb2sql object): the pdb structure that's being closed
+    """
+
+    _atom_cache.pop(pdb2sql, None)
+
+
+def _build_atoms_with_positions(pdb2sql):
+
     # This is a working dictionary of residues, identified by their chains and numbers.
     residues = {}
 
     # This is the dictionary of atom objects, its values will be returned.
     atoms = {}
 
+    # Positions per atom identifier, kept in sync with the atoms dictionary.
+    positions = {}
+
     # Iterate over the atom output from pdb2sql, select atoms with highest occupancy.
     request_s = "x,y,z,rowID,name,element,chainID,resSeq,resName,iCode,altLoc,occ"
     highest_occupancies = {}
@@ -88,6 +144,7 @@ def get_atoms(pdb2sql):
 
         # otherwise, overwrite..
         atoms[atom_id] = Atom(atom_number, atom_position, chain_id, atom_name, element, residues[residue_id], altloc, occ)
+        positions[atom_id] = atom_position
         highest_occupancies[atom_id] = occ
 
     # Link atoms to residues:
@@ -95,7 +152,32 @@ def get_atoms(pdb2sql):
         residue_id = (chain_id, residue_number, insertion_code)
         residues[residue_id].atoms.append(atom)
 
-    return list(atoms.values())
+    return list(atoms.values()), numpy.array(list(positions.values()))
+
+
+def match_residue_atoms(atoms, chain_id, residue_number, insertion_code):
+    """ Select the atoms that belong to one specific residue.
+
+        The comparison runs over numpy arrays of the residue attributes instead
+        of per-atom Python attribute checks, which matters when this is called
+        for many variants on the same structure.
+
+        Args:
+            atoms ([Atom]): the atoms to choose from
+            chain_id (str): the chain identifier, where the residue is located
+            residue_number (int): the residue number of interest within the chain
+            insertion_code (str): insertion code of the residue of interest, may be None
+
+        Returns (numpy array of int): indices of the matching atoms within the input list
+    """
+
+    chain_ids = numpy.array([atom.chain_id for atom in atoms], dtype=object)
+    residue_numbers = numpy.array([atom.residue.number for atom in atoms])
+    insertion_codes = numpy.array([atom.residue.insertion_code for atom in atoms], dtype=object)
+
+    mask = (chain_ids == chain_id) & (residue_numbers == residue_number) & (insertion_codes == insertion_code)
+
+    return numpy.nonzero(mask)[0]
 
 
 def get_residue_contact_atom_pairs(pdb2sql, chain_id, residue_number, insertion_code, max_interatomic_distance):
@@ -112,30 +194,26 @@ def get_residue_contact_atom_pairs(pdb2sql, chain_id, residue_number, insertion_
     """
 
     # get all the atoms in the pdb file:
-    atoms = get_atoms(pdb2sql)
-    atom_positions = numpy.array([atom.position for atom in atoms])
-    atoms_in_residue = numpy.array([atom for atom in atoms
-                                    if atom.residue.number == residue_number and
-                                    atom.chain_id == chain_id and
-                                    atom.residue.insertion_code == insertion_code])
+    atoms, atom_positions = get_atoms_with_positions(pdb2sql)
+    atoms_in_residue = [atoms[index] for index in match_residue_atoms(atoms, chain_id, residue_number, insertion_code)]
     if len(atoms_in_residue) == 0:
         raise ValueError("no atoms found for residue {} {}{}".format(chain_id, residue_number, insertion_code))
 
     atoms_in_residue_positions = numpy.array([atom.position for atom in atoms_in_residue])
 
-    # calculate euclidean distances
-    atom_distance_matrix = distance_matrix(atom_positions, atoms_in_residue_positions)
-
-    # select pairs that are close enough
-    neighbour_matrix = atom_distance_matrix < max_interatomic_distance
+    # Query a KD-tree over all atoms for the residue's atoms. The tree search
+    # prunes everything beyond the cutoff at C level, instead of computing a
+    # full atoms-by-residue-atoms distance matrix:
+    tree = cKDTree(atom_positions)
+    neighbour_indices = tree.query_ball_point(atoms_in_residue_positions, max_interatomic_distance)
 
     # Create a set of pair objects
     neighbour_pairs = set([])
-    for index0, index1 in numpy.transpose(numpy.nonzero(neighbour_matrix)):
-        atom0 = atoms[index0]
-        atom1 = atoms_in_residue[index1]
+    for residue_atom, indices in zip(atoms_in_residue, neighbour_indices):
+        for index in indices:
+            atom = atoms[index]
 
-        if atom0.residue != atom1.residue:
-            neighbour_pairs.add((Pair(atom0, atom1)))
+            if atom.residue != residue_atom.residue:
+                neighbour_pairs.add(Pair(atom, residue_atom))
 
     return neighbour_pairs
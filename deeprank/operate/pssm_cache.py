@@ -0,0 +1,56 @@
+import hashlib
+import os
+import pickle
+import tempfile
+
+from deeprank.parse.pssm import parse_pssm
+
+
+# Parsed PSSM files are persisted here across runs. Entries are keyed by the
+# source path, modification time and size, so a changed file never aliases a
+# stale entry. The location can be overridden through DEEPRANK_PSSM_CACHE.
+_CACHE_DIR = os.environ.get("DEEPRANK_PSSM_CACHE",
+                            os.path.join(tempfile.gettempdir(), "deeprank-pssm-cache"))
+
+
+def _cache_path(pssm_path, chain_id):
+    stat = os.stat(pssm_path)
+    key = "{}:{}:{}:{}".format(os.path.realpath(pssm_path),
+                               stat.st_mtime_ns, stat.st_size, chain_id)
+
+    return os.path.join(_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + ".pkl")
+
+
+def parse_pssm_cached(pssm_path, chain_id):
+    """ Parse a PSSM file, going through the on-disk cache.
+
+        The first parse of a file stores the parsed Pssm object in pickled
+        form; later runs load that directly instead of re-parsing the text.
+
+        Args:
+            pssm_path (str): path of the PSSM file
+            chain_id (str): chain that the PSSM file describes
+
+        Returns (Pssm): the parsed PSSM data
+    """
+
+    cache_path = _cache_path(pssm_path, chain_id)
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            pass  # treat an unreadable entry as a cache miss
+
+    with open(pssm_path, 'rt', encoding='utf_8') as f:
+        pssm = parse_pssm(f, chain_id)
+
+    # Write through a temporary file, so that concurrent workers
+    # never see a partially written entry:
+    os.makedirs(_CACHE_DIR, exist_ok=True)
+    temporary_path = "{}.{}.tmp".format(cache_path, os.getpid())
+    with open(temporary_path, 'wb') as f:
+        pickle.dump(pssm, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_path, cache_path)
+
+    return pssm
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import h5py
+import numpy as np
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+from deeprank.tools import sparse
+
+
+def get_grid_shape(mol_grp):
+    """Get the grid shape of one variant group.
+
+    Args:
+        mol_grp (hdf5 group): group of the variant in the hdf5 file
+
+    Returns:
+        tuple(int): the x,y,z size of the grid
+    """
+
+    nx = mol_grp['grid_points']['x'].shape[0]
+    ny = mol_grp['grid_points']['y'].shape[0]
+    nz = mol_grp['grid_points']['z'].shape[0]
+    return (nx, ny, nz)
+
+
+def stack_features(mol_grp, grid_shape):
+    """Stack all the mapped features of one variant into a single tensor.
+
+    Args:
+        mol_grp (hdf5 group): group of the variant in the hdf5 file
+        grid_shape (tuple(int)): the x,y,z size of the grid
+
+    Returns:
+        np.array, list(str): the (C,x,y,z) tensor and the channel names
+    """
+
+    channels = []
+    for feat_type, feat_names in mol_grp['mapped_features'].items():
+        for name in feat_names:
+            channels.append('%s/%s' % (feat_type, name))
+
+    stack = np.empty((len(channels),) + grid_shape, dtype='float32')
+    for ic, channel in enumerate(channels):
+        data = mol_grp['mapped_features/' + channel]
+        if data.attrs['sparse']:
+            stack[ic] = sparse.FLANgrid(sparse=True,
+                                        index=data['index'][:],
+                                        value=data['value'][:],
+                                        shape=grid_shape).to_dense()
+        else:
+            data['value'].read_direct(stack[ic])
+
+    return stack, channels
+
+
+def repack_database(fname, compression='lzf', dtype='float32'):
+    """Add a stacked feature dataset to every variant of an hdf5 file.
+
+    The stack holds all the mapped features of the variant as one
+    (C,x,y,z) dataset stored in a single chunk, so that loading one
+    sample during training costs one read instead of one per feature.
+    DataSet.load_one_variant picks the stack up automatically.
+
+    Args:
+        fname (str): name of the hdf5 file, modified in place
+        compression (str or None): 'bitshuffle', 'lzf', 'gzip' or None.
+            Bitshuffle+LZ4 reads back fastest and compresses float grids
+            best, but requires the hdf5plugin package both here and in
+            the process that reads the file.
+        dtype (str): on-disk type of the stack. 'float16' halves the
+            file size; the mapped CNN input features tolerate the
+            reduced precision.
+    """
+
+    if compression == 'bitshuffle':
+        if hdf5plugin is None:
+            raise ImportError(
+                'bitshuffle compression requires the hdf5plugin package')
+        compression = hdf5plugin.Bitshuffle(cname='lz4')
+
+    f5 = h5py.File(fname, 'a')
+
+    for mol_name in f5.keys():
+
+        mol_grp = f5[mol_name]
+        if 'mapped_features' not in mol_grp:
+            continue
+
+        if 'stack' in mol_grp:
+            del mol_grp['stack']
+
+        stack, channels = stack_features(mol_grp, get_grid_shape(mol_grp))
+
+        ds = mol_grp.create_dataset('stack', data=stack.astype(dtype, copy=False),
+                                    chunks=stack.shape,
+                                    compression=compression)
+        ds.attrs['channels'] = channels
+
+    f5.close()
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Repack hdf5 files for fast training reads')
+    parser.add_argument('hdf5', nargs='+',
+                        help='hdf5 files to repack in place')
+    parser.add_argument('--compression', default='lzf',
+                        choices=['none', 'lzf', 'gzip', 'bitshuffle'],
+                        help='compression of the stacked dataset; '
+                             'bitshuffle requires the hdf5plugin package')
+    parser.add_argument('--dtype', default='float32',
+                        choices=['float32', 'float16'],
+                        help='on-disk type of the stacked dataset')
+    args = parser.parse_args()
+
+    compression = None if args.compression == 'none' else args.compression
+    for fname in args.hdf5:
+        repack_database(fname, compression=compression, dtype=args.dtype)
@@ -0,0 +1,27 @@
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from nose.tools import eq_, ok_
+
+from deeprank.operate import pssm_cache
+
+
+def test_cache_roundtrip():
+    pssm_path = "test/data/pssm/101M/101M.A.pdb.pssm"
+
+    tmp_dir = mkdtemp()
+    original_cache_dir = pssm_cache._CACHE_DIR
+    pssm_cache._CACHE_DIR = tmp_dir
+    try:
+        pssm = pssm_cache.parse_pssm_cached(pssm_path, "A")
+        ok_(len(pssm) > 0)
+
+        # A cache entry should now exist and produce the same data:
+        ok_(os.path.isfile(pssm_cache._cache_path(pssm_path, "A")))
+
+        cached = pssm_cache.parse_pssm_cached(pssm_path, "A")
+        eq_(len(cached), len(pssm))
+    finally:
+        pssm_cache._CACHE_DIR = original_cache_dir
+        rmtree(tmp_dir)
@@ -0,0 +1,176 @@
+import os
+import pickle
+import sys
+from shutil import copyfile, rmtree
+from tempfile import mkdtemp
+
+import numpy
+from nose.tools import eq_, ok_
+
+from deeprank.models.variant import PdbVariantSelection, VariantClass
+from deeprank.generate.DataGenerator import DataGenerator
+from deeprank.learn.DataSet import DataSet
+from deeprank.models.environment import Environment
+from deeprank.domain.amino_acid import *
+import deeprank.config
+
+# the repack script is not part of the deeprank package:
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+from repack_for_training import repack_database
+
+
+deeprank.config.DEBUG = True
+
+
+_grid_info = {
+    'number_of_points': [20, 20, 20],
+    'resolution': [1., 1., 1.],
+    'atomic_densities': {'C': 1.7, 'N': 1.55, 'O': 1.52, 'S': 1.8},
+}
+
+_work_dir_path = None
+_hdf5_path = None
+
+
+def setup_module():
+    """ Generate one small database, shared by every test below.
+
+        These tests don't verify the features or targets themselves,
+        only that the alternative data paths of DataSet all serve the
+        same samples as plain per-item hdf5 reads.
+    """
+    global _work_dir_path, _hdf5_path
+
+    feature_modules = ["test.feature.feature1", "test.feature.feature2"]
+    target_modules = ["test.target.target1"]
+
+    environment = Environment(pdb_root="test/data/pdb", pssm_root="test/data/pssm")
+
+    variants = [PdbVariantSelection("101m", "A", 10, valine, cysteine,
+                                    protein_accession="P02144", protein_residue_number=10,
+                                    variant_class=VariantClass.BENIGN),
+                PdbVariantSelection("101m", "A", 9, glutamine, cysteine,
+                                    protein_accession="P02144", protein_residue_number=9,
+                                    variant_class=VariantClass.PATHOGENIC)]
+
+    _work_dir_path = mkdtemp()
+    _hdf5_path = os.path.join(_work_dir_path, "test.hdf5")
+
+    data_generator = DataGenerator(environment, variants,
+                                   data_augmentation=2,
+                                   compute_targets=target_modules,
+                                   compute_features=feature_modules,
+                                   hdf5=_hdf5_path)
+    data_generator.create_database()
+    data_generator.map_features(_grid_info)
+
+
+def teardown_module():
+    rmtree(_work_dir_path)
+
+
+def _make_dataset(hdf5_path, **kwargs):
+    kwargs.setdefault('normalize_features', True)
+    return DataSet(hdf5_path, grid_info=_grid_info,
+                   select_feature='all',
+                   select_target='target1',
+                   **kwargs)
+
+
+def _check_same_items(dataset, reference):
+    """ Check that two data sets serve identical samples. """
+
+    eq_(len(dataset), len(reference))
+    for index in range(len(reference)):
+        item = dataset[index]
+        expected = reference[index]
+
+        ok_(numpy.allclose(numpy.asarray(item['feature']),
+                           numpy.asarray(expected['feature'])))
+        ok_(numpy.allclose(numpy.asarray(item['target']),
+                           numpy.asarray(expected['target'])))
+
+
+def test_in_memory_matches_hdf5():
+    reference = _make_dataset(_hdf5_path)
+    preloaded = _make_dataset(_hdf5_path, in_memory=True)
+
+    _check_same_items(preloaded, reference)
+
+
+def test_memmap_matches_hdf5():
+    reference = _make_dataset(_hdf5_path)
+
+    memmap_path = os.path.join(_work_dir_path, "features.npy")
+    reference.to_memmap(memmap_path)
+
+    memmapped = _make_dataset(_hdf5_path)
+    memmapped.use_memmap(memmap_path)
+
+    _check_same_items(memmapped, reference)
+
+
+def test_stack_matches_per_feature():
+    reference = _make_dataset(_hdf5_path)
+
+    repacked_path = os.path.join(_work_dir_path, "repacked.hdf5")
+    copyfile(_hdf5_path, repacked_path)
+    repack_database(repacked_path)
+
+    stacked = _make_dataset(repacked_path)
+
+    _check_same_items(stacked, reference)
+
+
+def test_get_batch_matches_getitem():
+    from torch.utils.data.dataloader import default_collate
+
+    dataset = _make_dataset(_hdf5_path)
+
+    indices = list(range(len(dataset)))
+    batch = dataset.get_batch(indices)
+
+    # get_batch reorders the samples by file and variant name, so match
+    # each row of the batch back to its per-item read by variant name:
+    positions = {mol: index for index, (_, mol, _, _)
+                 in enumerate(dataset.index_complexes)}
+    items = [dataset[positions[mol]] for mol in batch['mol'][1]]
+    expected = default_collate(items)
+
+    ok_(numpy.allclose(batch['feature'].numpy(),
+                       expected['feature'].numpy()))
+    ok_(numpy.allclose(batch['target'].numpy(),
+                       expected['target'].numpy()))
+
+
+def test_pickled_copy_matches_original():
+    # a DataLoader pickles the data set to its workers under the spawn
+    # start method, after the open hdf5 handles and compiled callables
+    # already exist:
+    reference = _make_dataset(_hdf5_path,
+                              transform_to_2D=True, projection=1)
+    ok_(reference[0] is not None)
+
+    copied = pickle.loads(pickle.dumps(reference))
+
+    _check_same_items(copied, reference)
+
+
+def test_norm_npz_matches_pickle():
+    # a normalizing DataSet writes both the npz and the legacy pickle
+    # norm file, preferring the npz on read:
+    from_npz = _make_dataset(_hdf5_path)
+
+    npz_path = os.path.splitext(_hdf5_path)[0] + '_norm.npz'
+    hidden_path = npz_path + '.hidden'
+    os.rename(npz_path, hidden_path)
+    try:
+        from_pickle = _make_dataset(_hdf5_path)
+    finally:
+        os.rename(hidden_path, npz_path)
+
+    ok_(numpy.allclose(numpy.asarray(from_npz.feature_mean),
+                       numpy.asarray(from_pickle.feature_mean)))
+    ok_(numpy.allclose(numpy.asarray(from_npz.feature_std),
+                       numpy.asarray(from_pickle.feature_std)))
+    _check_same_items(from_pickle, from_npz)